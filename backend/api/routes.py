@@ -1,8 +1,9 @@
 """
 API routes for the Gemma Chatbot
 """
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import json
 import logging
 
 from ..models.schemas import (
@@ -13,7 +14,6 @@ from ..models.schemas import (
     SessionListResponse,
     MessageResponse
 )
-from ..services.chat_service import chat_service
 from ..config import settings
 
 logger = logging.getLogger(__name__)
@@ -21,23 +21,40 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+def require_chat_service(request: Request):
+    """
+    Dependency returning the chat service, or 503 while no model is loaded
+    Override it via app.dependency_overrides to inject a fake service.
+    """
+    chat_service = request.app.state.chat_service
+    if chat_service is None or not chat_service.is_model_loaded():
+        raise HTTPException(status_code=503, detail="Model is not loaded")
+    return chat_service
+
+
 @router.get("/health", response_model=HealthResponse)
-async def health_check():
+async def health_check(request: Request):
     """
     Check if the API and model are working
     """
     try:
-        # Test if chat service is initialized
-        model_status = "connected" if chat_service.is_model_loaded() else "disconnected"
+        # Test if chat service is initialized (absent while loading or on LOAD_MODEL=false workers)
+        chat_service = request.app.state.chat_service
+        if chat_service is None:
+            model_status = "loading" if request.app.state.model_loading else "disconnected"
+            active_sessions = 0
+        else:
+            model_status = "connected" if chat_service.is_model_loaded() else "disconnected"
+            active_sessions = chat_service.get_active_sessions_count()
         
         return HealthResponse(
             status="healthy",
             model_name=settings.MODEL_NAME,
             model_status=model_status,
-            active_sessions=chat_service.get_active_sessions_count()
+            active_sessions=active_sessions
         )
     except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
+        logger.error("Health check failed: %s", e)
         return JSONResponse(
             status_code=503,
             content={
@@ -49,18 +66,18 @@ async def health_check():
 
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, service=Depends(require_chat_service)):
     """
     Chat endpoint for conversational AI
     """
-    logger.info(f"💬 Received chat request for session: {request.session_id}")
-    logger.info(f"📝 Prompt: {request.prompt[:100]}...")
+    logger.info("💬 Received chat request for session: %s", request.session_id)
+    logger.info("📝 Prompt: %s...", request.prompt[:100])
     
     try:
         # Process chat
-        answer = await chat_service.chat(request.prompt, request.session_id)
+        answer = await service.chat(request.prompt, request.session_id, request.max_new_tokens)
         
-        logger.info(f"✅ Response generated for session {request.session_id}")
+        logger.info("✅ Response generated for session %s", request.session_id)
         
         return ChatResponse(
             answer=answer,
@@ -68,22 +85,47 @@ async def chat(request: ChatRequest):
         )
         
     except ValueError as e:
-        logger.error(f"❌ Validation error: {str(e)}")
+        logger.error("❌ Validation error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"❌ Error generating response: {str(e)}")
+        logger.error("❌ Error generating response: %s", e)
         raise HTTPException(
             status_code=500, 
             detail=f"Failed to generate response: {str(e)}"
         )
 
 
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, service=Depends(require_chat_service)):
+    """
+    Streaming chat endpoint (Server-Sent Events)
+    Sends a `data: {"token": ...}` event per generated chunk, then a
+    `done` event. Failures after the stream started arrive as an `error` event.
+    """
+    logger.info("💬 Received stream request for session: %s", request.session_id)
+    
+    async def event_stream():
+        try:
+            async for token in service.chat_stream(
+                request.prompt, request.session_id, request.max_new_tokens
+            ):
+                yield f"data: {json.dumps({'token': token})}\n\n"
+            yield f"event: done\ndata: {json.dumps({'session_id': request.session_id})}\n\n"
+            logger.info("✅ Stream completed for session %s", request.session_id)
+        except Exception as e:
+            logger.error("❌ Error streaming response: %s", e)
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @router.get("/sessions/{session_id}/info", response_model=SessionInfo)
-async def get_session_info(session_id: str):
+async def get_session_info(session_id: str, service=Depends(require_chat_service)):
     """
     Get information about a session
     """
-    if not chat_service.session_exists(session_id):
+    history = service.try_get(session_id)
+    if history is None:
         raise HTTPException(
             status_code=404, 
             detail=f"Session '{session_id}' not found"
@@ -91,34 +133,27 @@ async def get_session_info(session_id: str):
     
     return SessionInfo(
         session_id=session_id,
-        message_count=chat_service.get_message_count(session_id),
-        created_at=chat_service.get_session_created_time(session_id)
+        message_count=len(history),
+        created_at=history.created_at
     )
 
 
 @router.delete("/sessions/{session_id}", response_model=MessageResponse)
-async def delete_session(session_id: str):
+async def delete_session(session_id: str, service=Depends(require_chat_service)):
     """
     Delete a session and its chat history
+    Idempotent: deleting an unknown or already expired session succeeds too.
     """
     try:
-        if not chat_service.session_exists(session_id):
-            raise HTTPException(
-                status_code=404,
-                detail=f"Session '{session_id}' not found"
-            )
-        
-        chat_service.delete_session(session_id)
-        logger.info(f"✅ Deleted session {session_id}")
+        if await service.delete_session(session_id):
+            logger.info("✅ Deleted session %s", session_id)
         
         return MessageResponse(
             message=f"Session '{session_id}' deleted successfully"
         )
         
-    except HTTPException:
-        raise
     except Exception as e:
-        logger.error(f"❌ Error deleting session: {str(e)}")
+        logger.error("❌ Error deleting session: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to delete session: {str(e)}"
@@ -126,18 +161,17 @@ async def delete_session(session_id: str):
 
 
 @router.post("/sessions/{session_id}/clear-history", response_model=MessageResponse)
-async def clear_session_history(session_id: str):
+async def clear_session_history(session_id: str, service=Depends(require_chat_service)):
     """
     Clear chat history for a session
     """
-    if not chat_service.session_exists(session_id):
+    if not await service.clear_history(session_id):
         raise HTTPException(
             status_code=404, 
             detail=f"Session '{session_id}' not found"
         )
     
-    chat_service.clear_history(session_id)
-    logger.info(f"✅ Cleared history for session {session_id}")
+    logger.info("✅ Cleared history for session %s", session_id)
     
     return MessageResponse(
         message=f"Chat history cleared for session '{session_id}'"
@@ -145,13 +179,13 @@ async def clear_session_history(session_id: str):
 
 
 @router.get("/sessions", response_model=SessionListResponse)
-async def list_sessions():
+async def list_sessions(service=Depends(require_chat_service)):
     """
     List all active sessions
     """
-    sessions = chat_service.get_all_sessions()
+    sessions = service.get_all_sessions()
     
-    return SessionListResponse(
-        sessions=sessions,
-        count=len(sessions)
-    )
\ No newline at end of file
+    # Returning a Response skips FastAPI's response_model re-validation; the items
+    # are trusted, so model_construct + pydantic-core JSON is all the work done here
+    payload = SessionListResponse.model_construct(sessions=sessions, count=len(sessions))
+    return Response(content=payload.model_dump_json(), media_type="application/json")
\ No newline at end of file
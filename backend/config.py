@@ -14,15 +14,43 @@ class Settings(BaseSettings):
     API_TITLE: str = "Qwen Chatbot API"
     API_VERSION: str = "1.0.0"
     
+    # Server Settings
+    WEB_CONCURRENCY: int = 1  # Uvicorn worker processes; sessions are per process, so >1 needs sticky sessions
+    RELOAD: bool = False  # Auto-reload on code changes (development only, single worker)
+    LOAD_MODEL: bool = True  # False for workers that only serve health/session endpoints
+    
     # Model Settings
     MODEL_NAME: str = "./qwen-world-history"
     MODEL_DEVICE: str = "cpu"  # "cuda" for GPU, "cpu" for CPU
+    MODEL_DTYPE: str = "auto"  # "auto", "bfloat16", "float16" or "float32"
+    LOAD_IN_8BIT: bool = False  # bitsandbytes int8 weights (CUDA only)
+    TORCH_COMPILE: bool = False  # torch.compile the model forward pass
+    MODEL_WARMUP: bool = True  # Run a throwaway generate at startup to absorb lazy init
     TEMPERATURE: float = 0.7
     MAX_TOKENS: int = 512
+    MAX_CONTEXT_TOKENS: int = 4096  # Prompt + generated tokens never exceed this
     TOP_P: float = 0.9
     
     # Session Settings
     MAX_HISTORY_LENGTH: int = 10  # Keep last N message pairs
+    MAX_HISTORY_CHARS: int = 20000  # Drop oldest messages once a history holds more characters
+    HISTORY_POOL_SIZE: int = 64  # Histories of ended sessions kept for reuse
+    MAX_INPUT_TOKENS: int = 2048  # Prompt budget; oldest history is dropped beyond it
+    MAX_SESSIONS: int = 1000  # LRU cap on in-memory sessions
+    SESSION_TTL_SEC: int = 3600  # Idle sessions are evicted after this many seconds
+    
+    # KV Cache Settings
+    KV_CACHE_ENABLED: bool = True  # Reuse past_key_values of repeated prompt prefixes
+    KV_CACHE_BLOCK_SIZE: int = 128  # Prefix match granularity (tokens)
+    KV_CACHE_MAX_BLOCKS: int = 256  # Bound on cached KV blocks kept on the model device
+    KV_COLD_DIR: Optional[str] = None  # Offload evicted blocks here (one subdirectory per worker) and reload them on reuse
+    KV_COLD_MAX_BLOCKS: int = 1024  # LRU bound on offloaded blocks
+    KV_MMAP_DIR: Optional[str] = None  # Persist session KV here on eviction/shutdown to resume after restarts (CPU only)
+    KV_MMAP_MAX_SESSIONS: int = 1000  # Oldest persisted sessions are removed beyond this
+    
+    # Batching Settings
+    BATCH_MAX_SIZE: int = 4  # Max concurrent prompts merged into one generate call
+    BATCH_MAX_WAIT_MS: int = 20  # How long the batch worker waits to fill a batch
     
     # Model Loading
     USE_OLLAMA: bool = False  # If True, use Ollama instead of HuggingFace
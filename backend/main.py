@@ -1,13 +1,17 @@
 """
 Main FastAPI application for Gemma Chatbot
 """
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import logging
 import sys
 
 from backend.api.routes import router
 from backend.config import settings
+from backend.services.chat_service import get_chat_service
 
 # Configure logging
 logging.basicConfig(
@@ -20,13 +24,71 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+
+async def load_chat_service(app: FastAPI):
+    """
+    Load the model in a worker thread and publish it on app.state
+    Runs in the background so the event loop (and /health) stays responsive
+    during the 1-2 minute load.
+    """
+    logger.info("🔨 Initializing chat_service...")
+    try:
+        service = await asyncio.to_thread(get_chat_service)
+    except Exception as e:
+        logger.error("="*70)
+        logger.error("❌ CRITICAL: Failed to initialize chat_service")
+        logger.error("Error: %s", e)
+        logger.error("="*70)
+        logger.error("The server will keep running but chat endpoints will not work!")
+        logger.error("Please check the errors above and fix the issue.")
+        logger.error("="*70)
+        return
+    
+    service.start_batch_worker()
+    app.state.chat_service = service
+    logger.info("🎉 chat_service ready!")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Application startup and shutdown
+    """
+    logger.info("🚀 Starting Gemma Chatbot API...")
+    logger.info("📦 Model: %s", settings.MODEL_NAME)
+    logger.info("🌡️  Temperature: %s", settings.TEMPERATURE)
+    logger.info("📝 Max Tokens: %s", settings.MAX_TOKENS)
+    
+    app.state.chat_service = None
+    app.state.model_loading = settings.LOAD_MODEL
+    load_task = None
+    if settings.LOAD_MODEL:
+        load_task = asyncio.create_task(load_chat_service(app))
+        load_task.add_done_callback(lambda _: setattr(app.state, "model_loading", False))
+    else:
+        logger.info("⏭️ LOAD_MODEL is disabled, skipping chat_service initialization")
+    logger.info("✅ API is ready!")
+    
+    yield
+    
+    logger.info("👋 Shutting down Gemma Chatbot API...")
+    if load_task is not None and not load_task.done():
+        load_task.cancel()
+    if app.state.chat_service is not None:
+        await app.state.chat_service.stop_batch_worker()
+        await asyncio.to_thread(app.state.chat_service.close)
+
+
 # Create FastAPI app
 app = FastAPI(
     title=settings.API_TITLE,
     version=settings.API_VERSION,
     description="A simple conversational chatbot powered by Google Gemma-3-1B-IT",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    # Needs the fastapi pin in requirements.txt: newer releases deprecate ORJSONResponse
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -56,32 +118,18 @@ async def root():
     }
 
 
-@app.on_event("startup")
-async def startup_event():
-    """
-    Run on application startup
-    """
-    logger.info("🚀 Starting Gemma Chatbot API...")
-    logger.info(f"📦 Model: {settings.MODEL_NAME}")
-    logger.info(f"🌡️  Temperature: {settings.TEMPERATURE}")
-    logger.info(f"📝 Max Tokens: {settings.MAX_TOKENS}")
-    logger.info("✅ API is ready!")
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """
-    Run on application shutdown
-    """
-    logger.info("👋 Shutting down Gemma Chatbot API...")
-
-
 if __name__ == "__main__":
+    import os
     import uvicorn
+    workers = 1 if settings.RELOAD else settings.WEB_CONCURRENCY
+    # Workers re-read settings: give them the real count so they split CPU threads by it
+    os.environ["WEB_CONCURRENCY"] = str(workers)
     uvicorn.run(
         "backend.main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        reload=settings.RELOAD,
+        # Each worker is a separate process with its own copy of the model
+        workers=workers,
         log_level="info"
     )
\ No newline at end of file
@@ -1,43 +1,41 @@
 """
 Pydantic models for request and response validation
 """
-from pydantic import BaseModel, Field, validator
-from typing import Optional, List
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Annotated, Optional, List
 from datetime import datetime
 
+from backend.config import settings
+
+
+# Constraints are enforced by pydantic-core, no Python validators per request
+PromptStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=5000)]
+SessionIdStr = Annotated[str, StringConstraints(min_length=5, pattern=r"^[A-Za-z0-9_-]+$")]
+
 
 class ChatRequest(BaseModel):
     """Request model for chat endpoint"""
-    prompt: str = Field(
+    prompt: PromptStr = Field(
         ..., 
-        min_length=1, 
-        max_length=5000, 
         description="User's message/question"
     )
-    session_id: str = Field(
+    session_id: SessionIdStr = Field(
         ..., 
-        min_length=5, 
         description="Unique session identifier"
     )
-    
-    @validator('prompt')
-    def prompt_not_empty(cls, v):
-        if not v.strip():
-            raise ValueError('Prompt cannot be empty or whitespace')
-        return v.strip()
-    
-    @validator('session_id')
-    def validate_session_format(cls, v):
-        # Allow flexible session ID format
-        if not v or len(v) < 5:
-            raise ValueError('Session ID must be at least 5 characters')
-        return v
+    max_new_tokens: Optional[int] = Field(
+        None,
+        ge=1,
+        le=settings.MAX_TOKENS,
+        description="Cap on generated tokens for this reply (defaults to MAX_TOKENS)"
+    )
     
     class Config:
         json_schema_extra = {
             "example": {
                 "prompt": "Hello! How are you?",
-                "session_id": "session_12345"
+                "session_id": "session_12345",
+                "max_new_tokens": 256
             }
         }
 
@@ -2,12 +2,16 @@
 Chat Service Implementation with Fine-tuned Qwen Model
 CPU-OPTIMIZED VERSION - No quantization needed for CPU
 """
-import sys
 import os
-from typing import Dict, List
+import asyncio
+import threading
+import time
+import weakref
+from collections import deque
+from functools import lru_cache, partial
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
 import logging
-from datetime import datetime
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig
+from cachetools import TTLCache
 # Setup logging first
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,61 +19,347 @@ logger = logging.getLogger(__name__)
 # Import AI libraries
 try:
     import torch
-    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from transformers import (
+        AutoModelForCausalLM,
+        AutoTokenizer,
+        StoppingCriteria,
+        StoppingCriteriaList,
+        TextStreamer
+    )
     logger.info("✅ PyTorch and Transformers imported")
 except ImportError as e:
-    logger.error(f"❌ Failed to import AI libraries: {e}")
+    logger.error("❌ Failed to import AI libraries: %s", e)
     logger.error("Install with: pip install torch transformers")
     raise
 
-# Import config with better error handling
-try:
-    from backend.config import settings
-except ImportError:
-    try:
-        from ..config import settings
-    except ImportError:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        project_root = os.path.dirname(os.path.dirname(current_dir))
-        sys.path.insert(0, project_root)
-        from backend.config import settings
+from backend.config import settings
+from backend.models.schemas import SessionListItem
+from backend.utils.helpers import now_iso
+from backend.services.kv_cache import PrefixKVCache, SessionKVStore
+
+logger.info("✅ Config loaded: %s", settings.MODEL_NAME)
+
+SYSTEM_PROMPT = (
+    "You are a knowledgeable world history expert. "
+    "Provide accurate, detailed, and engaging historical information."
+)
 
-logger.info(f"✅ Config loaded: {settings.MODEL_NAME}")
+# Generation stops once the model starts writing the next user turn itself
+STOP_STRINGS = ["\nUser:"]
+
+# Shorter (stripped) responses are replaced by FALLBACK_RESPONSE
+MIN_RESPONSE_CHARS = 5
+
+# Fixed reply texts, built once at import instead of on every call
+FALLBACK_RESPONSE = (
+    "I apologize, but I couldn't generate a proper response. "
+    "Please try rephrasing your question."
+)
+MODEL_NOT_LOADED_MESSAGE = (
+    "Model is not loaded. Please check server logs. "
+    "The model should load automatically on startup."
+)
+
+
+def streamable_prefix(text: str) -> str:
+    """
+    Part of a partially generated response that the final response will start with
+    Cuts at the first stop string, holds back a tail that may still grow into
+    one, and returns "" while the response could still end up as the fallback.
+    """
+    end = len(text)
+    for stop in STOP_STRINGS:
+        found = text.find(stop)
+        if found != -1:
+            end = min(end, found)
+    longest_stop = max(len(stop) for stop in STOP_STRINGS)
+    for start in range(max(0, len(text) - longest_stop + 1), end):
+        if any(stop.startswith(text[start:]) for stop in STOP_STRINGS):
+            end = start
+            break
+    text = text[:end].strip()
+    return text if len(text) >= MIN_RESPONSE_CHARS else ""
 
 
 class ChatMessage:
     """Simple message class"""
-    def __init__(self, role: str, content: str):
+    # No per-instance __dict__: thousands of sessions hold many of these
+    __slots__ = ("role", "content", "token_ids")
+    
+    def __init__(self, role: str, content: str, token_ids: Optional["torch.Tensor"] = None):
         self.role = role
         self.content = content
+        # Chat-template token IDs of this turn, filled on first use
+        self.token_ids = token_ids
     
     def __repr__(self):
         return f"ChatMessage(role={self.role}, content={self.content[:50]}...)"
 
 
-class SimpleChatHistory:
-    """Simple in-memory chat history"""
-    def __init__(self):
-        self.messages: List[ChatMessage] = []
+class BoundedChatHistory:
+    """
+    In-memory chat history bounded by turn count and total characters
+    Oldest messages are dropped first once either cap is exceeded, so memory
+    per session and prompt assembly cost stay flat however long a chat runs.
+    """
+    __slots__ = ("_deque", "char_cap", "_chars", "_on_change", "created_at")
+    
+    def __init__(
+        self,
+        max_turns: int,
+        char_cap: int,
+        on_change: Optional[Callable[[int], None]] = None,
+        created_at: Optional[str] = None
+    ):
+        # Stored on the history so it is evicted together with the session
+        self.created_at = created_at or now_iso()
+        # Bounded deque: appending past maxlen drops the oldest message in O(1)
+        self._deque: "deque[ChatMessage]" = deque(maxlen=2 * max_turns)
+        self.char_cap = char_cap
+        self._chars = 0
+        # Called with the new message count whenever messages are added or cleared
+        self._on_change = on_change
+    
+    @property
+    def messages(self) -> List[ChatMessage]:
+        """Snapshot of the messages, oldest first"""
+        return list(self._deque)
+    
+    def append(self, message: ChatMessage):
+        """Append a message, evicting from the left to stay within both caps"""
+        if len(self._deque) == self._deque.maxlen:
+            self._chars -= len(self._deque[0].content)
+        self._deque.append(message)
+        self._chars += len(message.content)
+        # The newest message is always kept, even if it alone exceeds char_cap
+        while self._chars > self.char_cap and len(self._deque) > 1:
+            self._chars -= len(self._deque.popleft().content)
+    
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(len(self._deque))
     
-    def add_user_message(self, message: str):
+    def add_user_message(self, message: str, token_ids: Optional["torch.Tensor"] = None):
         """Add user message"""
-        self.messages.append(ChatMessage("user", message))
-        logger.debug(f"Added user message: {message[:50]}...")
+        self.append(ChatMessage("user", message, token_ids))
+        self._changed()
+        logger.debug("Added user message: %s...", message[:50])
     
-    def add_ai_message(self, message: str):
+    def add_ai_message(self, message: str, token_ids: Optional["torch.Tensor"] = None):
         """Add AI message"""
-        self.messages.append(ChatMessage("assistant", message))
-        logger.debug(f"Added AI message: {message[:50]}...")
+        self.append(ChatMessage("assistant", message, token_ids))
+        self._changed()
+        logger.debug("Added AI message: %s...", message[:50])
     
     def clear(self):
         """Clear all messages"""
-        count = len(self.messages)
-        self.messages = []
-        logger.debug(f"Cleared {count} messages")
+        count = len(self._deque)
+        self._deque.clear()
+        self._chars = 0
+        self._changed()
+        logger.debug("Cleared %s messages", count)
+    
+    def reset(
+        self,
+        on_change: Optional[Callable[[int], None]] = None,
+        created_at: Optional[str] = None
+    ):
+        """Empty the history for reuse by another session"""
+        self._deque.clear()
+        self._chars = 0
+        self._on_change = on_change
+        self.created_at = created_at or now_iso()
     
     def __len__(self):
-        return len(self.messages)
+        return len(self._deque)
+    
+    def __iter__(self):
+        return iter(self._deque)
+    
+    def __reversed__(self):
+        return reversed(self._deque)
+
+
+class IncrementalTextStreamer(TextStreamer):
+    """
+    Streamer that decodes only a short rolling window per token
+    The stock streamer re-decodes every generated token on each step (O(n^2)
+    over a response). Here only the tokens since the last emitted chunk
+    (plus the preceding chunk as context for merges/spacing) are decoded.
+    Each chunk is passed to on_text, then None once the stream ends.
+    """
+    def __init__(self, tokenizer, on_text: Callable[[Optional[str]], None], **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.on_text = on_text
+        self.prefix_offset = 0
+        self.read_offset = 0
+    
+    def put(self, value):
+        if len(value.shape) > 1 and value.shape[0] > 1:
+            raise ValueError("IncrementalTextStreamer only supports batch size 1")
+        elif len(value.shape) > 1:
+            value = value[0]
+        
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        
+        self.token_cache.extend(value.tolist())
+        prefix_text = self.tokenizer.decode(
+            self.token_cache[self.prefix_offset:self.read_offset], **self.decode_kwargs
+        )
+        new_text = self.tokenizer.decode(self.token_cache[self.prefix_offset:], **self.decode_kwargs)
+        # A trailing U+FFFD means a multi-byte character is still incomplete
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_cache)
+            self.on_finalized_text(new_text[len(prefix_text):])
+    
+    def end(self):
+        printable_text = ""
+        if len(self.token_cache) > self.read_offset:
+            prefix_text = self.tokenizer.decode(
+                self.token_cache[self.prefix_offset:self.read_offset], **self.decode_kwargs
+            )
+            new_text = self.tokenizer.decode(self.token_cache[self.prefix_offset:], **self.decode_kwargs)
+            printable_text = new_text[len(prefix_text):]
+        
+        self.token_cache = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.next_tokens_are_prompt = True
+        self.on_finalized_text(printable_text, stream_end=True)
+    
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(text)
+        if stream_end:
+            self.on_text(None)
+
+
+class CancelCriteria(StoppingCriteria):
+    """Stops generate() at the next token once the event is set (e.g. client disconnected)"""
+    def __init__(self, cancel: threading.Event):
+        self.cancel = cancel
+    
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> torch.Tensor:
+        return torch.full((input_ids.shape[0],), self.cancel.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class SessionCache(TTLCache):
+    """
+    TTL + LRU bounded session store
+    Calls on_evict for every session dropped by expiry or capacity, so the
+    owner can release state kept outside the cache (KV, /sessions entries).
+    """
+    def __init__(self, maxsize: int, ttl: float, on_evict, timer: Callable[[], float] = time.monotonic):
+        super().__init__(maxsize=maxsize, ttl=ttl, timer=timer)
+        self._on_evict = on_evict
+    
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for session_id, history in expired:
+            self._on_evict(session_id, history)
+        return expired
+    
+    def popitem(self):
+        session_id, history = super().popitem()
+        self._on_evict(session_id, history)
+        return session_id, history
+
+
+class PromptBatcher:
+    """
+    Collects concurrent generation requests into batches
+    A background task takes the first queued prompt, waits up to max_wait_ms
+    for more (at most max_size in total) and runs them in one call: a lone
+    prompt goes to infer_one (keeps prefix KV reuse), more go to infer_batch.
+    Both callables are blocking and run in a worker thread.
+    """
+    def __init__(
+        self,
+        infer_one: Callable[..., str],
+        infer_batch: Callable[[List["torch.Tensor"], List[Optional[int]]], List[str]],
+        max_size: int,
+        max_wait_ms: int
+    ):
+        self._infer_one = infer_one
+        self._infer_batch = infer_batch
+        self.max_size = max_size
+        self.max_wait_ms = max_wait_ms
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def start(self) -> None:
+        """Start the collector task (must run inside the event loop)"""
+        if not self.running:
+            self._task = asyncio.create_task(self._collect())
+            logger.info("📦 Batch worker started (max size %s, window %sms)", self.max_size, self.max_wait_ms)
+    
+    async def stop(self) -> None:
+        """Cancel the collector task and fail requests still waiting in the queue"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while not self._queue.empty():
+            *_, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batch worker stopped"))
+    
+    async def submit(self, input_ids: "torch.Tensor", max_new_tokens: Optional[int] = None) -> str:
+        """Queue a prompt and wait for its response"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((input_ids, max_new_tokens, future))
+        return await future
+    
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Requests cancelled while queued (client went away) are dropped
+            batch = [item for item in batch if not item[-1].done()]
+            if not batch:
+                continue
+            
+            try:
+                if len(batch) == 1:
+                    input_ids, max_new_tokens, _ = batch[0]
+                    responses = [await asyncio.to_thread(
+                        self._infer_one, input_ids, max_new_tokens=max_new_tokens
+                    )]
+                else:
+                    responses = await asyncio.to_thread(
+                        self._infer_batch,
+                        [item[0] for item in batch],
+                        [item[1] for item in batch]
+                    )
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (*_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
 
 
 class ChatService:
@@ -84,18 +374,79 @@ class ChatService:
         logger.info("🚀 INITIALIZING CHAT SERVICE")
         logger.info("="*70)
         
-        self.session_store: Dict[str, SimpleChatHistory] = {}
-        self.session_created: Dict[str, str] = {}
+        self.session_store: SessionCache = SessionCache(
+            maxsize=settings.MAX_SESSIONS,
+            ttl=settings.SESSION_TTL_SEC,
+            on_evict=self._on_session_evicted
+        )
+        # Recycled histories of deleted/evicted sessions, reused on session creation
+        self._history_pool: List[BoundedChatHistory] = []
+        # /sessions payload, kept up to date as sessions and messages change
+        self._session_items: Dict[str, SessionListItem] = {}
         self.model = None
         self.tokenizer = None
         self.model_loaded = False
         
+        # Constant template token IDs, computed once in _load_model
+        self._sys_text: Optional[str] = None
+        self._sys_ids: Optional[torch.Tensor] = None
+        self._gen_prompt_ids: Optional[torch.Tensor] = None
+        
+        # Prefix KV cache: reuses prefill work for system prompt + history
+        self._kv_cache = PrefixKVCache(
+            block_size=settings.KV_CACHE_BLOCK_SIZE,
+            max_blocks=settings.KV_CACHE_MAX_BLOCKS,
+            cold_dir=settings.KV_COLD_DIR,
+            max_cold_blocks=settings.KV_COLD_MAX_BLOCKS
+        )
+        
+        # Dynamic batching: chat() submits, the batcher drains into generate()
+        self._batcher = PromptBatcher(
+            infer_one=self._generate_response,
+            infer_batch=self._generate_batch,
+            max_size=settings.BATCH_MAX_SIZE,
+            max_wait_ms=settings.BATCH_MAX_WAIT_MS
+        )
+        
+        # Batch worker and streaming threads share one model; run one generate at a time
+        self._generate_lock = threading.Lock()
+        
+        # Per-session turn locks; entries vanish once no request holds them
+        self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        
+        # Evicted sessions whose snapshot is not written yet: (messages, created_at).
+        # Their KV stays bound until then, so a returning user is revived from memory.
+        self._evicted: Dict[str, Tuple[List[ChatMessage], str]] = {}
+        self._snapshot_tasks: Set[asyncio.Task] = set()
+        
+        # Pinned host staging buffer for CUDA input copies, allocated on first use
+        self._in_buf: Optional[torch.Tensor] = None
+        self._in_copied = None
+        
         # Determine device
         self.device = self._get_device()
+        if self.device == "cpu":
+            # Split cores between worker processes to avoid oversubscription
+            # (WEB_CONCURRENCY is the worker count actually started, see main.py)
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // settings.WEB_CONCURRENCY))
         
         # Load model
         self._load_model()
         
+        # Disk-backed session KV for resume across restarts (mmap is CPU only);
+        # snapshots are tied to the loaded model and dtype
+        self._session_kv_store = None
+        if settings.KV_MMAP_DIR and self.device != "cuda" and self.model_loaded:
+            self._session_kv_store = SessionKVStore(
+                settings.KV_MMAP_DIR,
+                max_sessions=settings.KV_MMAP_MAX_SESSIONS,
+                fingerprint={
+                    "model": settings.MODEL_NAME,
+                    "dtype": str(self.model.dtype).replace("torch.", "")
+                }
+            )
+            logger.info("💾 Persisting session KV to: %s", settings.KV_MMAP_DIR)
+        
         logger.info("="*70)
         if self.model_loaded:
             logger.info("✅ CHAT SERVICE INITIALIZED SUCCESSFULLY")
@@ -110,8 +461,8 @@ class ChatService:
                 device = "cuda"
                 gpu_name = torch.cuda.get_device_name(0)
                 gpu_memory = torch.cuda.get_device_properties(0).total_memory / (1024**3)
-                logger.info(f"🎮 Using GPU: {gpu_name}")
-                logger.info(f"💾 GPU Memory: {gpu_memory:.1f} GB")
+                logger.info("🎮 Using GPU: %s", gpu_name)
+                logger.info("💾 GPU Memory: %.1f GB", gpu_memory)
             else:
                 device = "cpu"
                 logger.info("💻 Using CPU")
@@ -119,9 +470,50 @@ class ChatService:
                     logger.warning("⚠️  CUDA requested but not available, using CPU")
             return device
         except Exception as e:
-            logger.warning(f"⚠️ Error detecting device, defaulting to CPU: {e}")
+            logger.warning("⚠️ Error detecting device, defaulting to CPU: %s", e)
             return "cpu"
     
+    def _get_dtype(self) -> "torch.dtype":
+        """Resolve MODEL_DTYPE, preferring bf16 where the hardware runs it natively"""
+        requested = settings.MODEL_DTYPE.lower()
+        if requested != "auto":
+            return getattr(torch, requested)
+        if self.device == "cuda":
+            return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        # bf16 on CPU only pays off with AVX-512 BF16 / AMX, otherwise it is emulated
+        is_bf16_cpu = getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)
+        return torch.bfloat16 if is_bf16_cpu() else torch.float32
+    
+    def _to_device(self, inputs):
+        """
+        Move tokenized inputs to the model device
+        On CUDA they are staged in one reusable pinned buffer and copied with
+        non_blocking=True; on CPU the tensors are used as-is (zero copy).
+        Callers hold _generate_lock, so the staging buffer is never shared.
+        """
+        if self.device != "cuda":
+            return inputs
+        
+        # Don't overwrite the staging buffer while the previous H2D copy is in flight
+        if self._in_copied is not None:
+            self._in_copied.synchronize()
+        total = sum(tensor.numel() for tensor in inputs.values())
+        if self._in_buf is None or self._in_buf.numel() < total:
+            self._in_buf = torch.empty(
+                max(total, 2 * settings.MAX_INPUT_TOKENS), dtype=torch.long, pin_memory=True
+            )
+        
+        device_inputs = {}
+        offset = 0
+        for key, tensor in inputs.items():
+            staged = self._in_buf[offset:offset + tensor.numel()].view(tensor.shape)
+            staged.copy_(tensor)
+            device_inputs[key] = staged.to(self.device, non_blocking=True)
+            offset += tensor.numel()
+        self._in_copied = torch.cuda.Event()
+        self._in_copied.record()
+        return device_inputs
+    
     def _load_model(self):
         """
         Load Fine-tuned Qwen Model from LOCAL directory
@@ -129,7 +521,7 @@ class ChatService:
         """
         try:
             model_name = settings.MODEL_NAME
-            logger.info(f"📥 Loading model: {model_name}")
+            logger.info("📥 Loading model: %s", model_name)
             logger.info("⏳ This may take 1-2 minutes...")
             
             # Check if model path exists
@@ -139,12 +531,13 @@ class ChatService:
                     f"Make sure the model folder exists with config.json and model files"
                 )
             
-            logger.info(f"✅ Found local model at: {model_name}")
+            logger.info("✅ Found local model at: %s", model_name)
             
             # STEP 1: Load tokenizer
             logger.info("🔤 Step 1/2: Loading tokenizer...")
             self.tokenizer = AutoTokenizer.from_pretrained(
                 model_name,
+                use_fast=True,
                 trust_remote_code=True,
                 local_files_only=True
             )
@@ -154,45 +547,79 @@ class ChatService:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
                 logger.debug("Set pad_token = eos_token")
             
+            # Decoder-only batched generation needs prompts padded on the left
+            self.tokenizer.padding_side = "left"
+            
+            # Template pieces that never change: system turn and assistant header
+            system_message = [{"role": "system", "content": SYSTEM_PROMPT}]
+            self._sys_text = self.tokenizer.apply_chat_template(system_message, tokenize=False)
+            self._sys_ids = self._apply_template(system_message)
+            self._gen_prompt_ids = self._apply_template(
+                system_message, add_generation_prompt=True
+            )[len(self._sys_ids):]
+            
             logger.info("✅ Tokenizer loaded successfully")
             
-            # STEP 2: Load model (8-bit quantized)
+            # STEP 2: Load model (bf16 / int8 to halve memory traffic per decode step)
             logger.info("🤖 Step 2/2: Loading model...")
-            logger.info(f"   Target device: {self.device}")
-            logger.info("   Model is 8-bit quantized (will load automatically)")
+            logger.info("   Target device: %s", self.device)
+            
+            load_kwargs = {}
+            if settings.LOAD_IN_8BIT and self.device == "cuda":
+                from transformers import BitsAndBytesConfig
+                load_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+                load_kwargs["device_map"] = "auto"
+                logger.info("   Quantization: 8-bit (bitsandbytes)")
+            else:
+                load_kwargs["torch_dtype"] = self._get_dtype()
+                if self.device == "cuda":
+                    load_kwargs["device_map"] = self.device
+                logger.info("   Dtype: %s", load_kwargs['torch_dtype'])
             
             self.model = AutoModelForCausalLM.from_pretrained(
                 model_name,
                 trust_remote_code=True,
                 low_cpu_mem_usage=True,
-                local_files_only=True
-                # device_map and dtype handled automatically for quantized models
+                local_files_only=True,
+                **load_kwargs
             )
             
             # DON'T call .to() for quantized models - they handle device themselves
-            logger.info(f"✅ Model loaded successfully (8-bit quantized)")
+            logger.info("✅ Model loaded successfully")
             
             # Set to evaluation mode
             self.model.eval()
             
+            # Compile forward only: generate() stays on the HF model object
+            if settings.TORCH_COMPILE:
+                logger.info("⚙️ Compiling model forward with torch.compile...")
+                self.model.forward = torch.compile(
+                    self.model.forward,
+                    mode="reduce-overhead",
+                    fullgraph=False
+                )
+            
+            if settings.MODEL_WARMUP:
+                self._warmup()
+            
             # Calculate model stats
             param_count = sum(p.numel() for p in self.model.parameters())
             
             logger.info("✅ Model ready for inference!")
-            logger.info(f"📊 Model stats:")
+            logger.info("📊 Model stats:")
             logger.info(f"   Parameters: {param_count:,} ({param_count/1e9:.2f}B)")
             try:
-                logger.info(f"   Device: {next(self.model.parameters()).device}")
-                logger.info(f"   Dtype: {next(self.model.parameters()).dtype}")
+                logger.info("   Device: %s", next(self.model.parameters()).device)
+                logger.info("   Dtype: %s", next(self.model.parameters()).dtype)
             except:
-                logger.info(f"   Device: Multiple (8-bit uses special placement)")
+                logger.info("   Device: Multiple (8-bit uses special placement)")
             
             self.model_loaded = True
             
         except Exception as e:
             logger.error("="*70)
             logger.error("❌ MODEL LOADING FAILED")
-            logger.error(f"Error: {str(e)}")
+            logger.error("Error: %s", e)
             
             import traceback
             logger.error("Full error traceback:")
@@ -200,7 +627,7 @@ class ChatService:
             
             logger.error("="*70)
             logger.error("💡 Troubleshooting tips:")
-            logger.error(f"   1. Check model path exists: {settings.MODEL_NAME}")
+            logger.error("   1. Check model path exists: %s", settings.MODEL_NAME)
             logger.error("   2. Ensure bitsandbytes is installed: pip install bitsandbytes")
             logger.error("   3. Ensure model files (*.safetensors or *.bin) are present")
             logger.error("   4. Check you have ~4GB free RAM (8-bit saves memory)")
@@ -209,209 +636,614 @@ class ChatService:
             raise
 
 
+    def _warmup(self):
+        """
+        Run a few throwaway generate calls so lazy work (CUDA kernel loading,
+        torch.compile tracing, 8-bit setup) happens at startup instead of on
+        the first user request. Compiled models are warmed at two prompt
+        lengths so both graphs are cached.
+        """
+        prompt_ids = torch.cat([self._sys_ids, self._gen_prompt_ids])
+        seq_lens = [len(prompt_ids)]
+        if settings.TORCH_COMPILE:
+            seq_lens = [min(n, settings.MAX_INPUT_TOKENS) for n in (128, 1024)]
+        
+        logger.info("🔥 Warming up model...")
+        start = time.perf_counter()
+        try:
+            for seq_len in seq_lens:
+                input_ids = prompt_ids.repeat(seq_len // len(prompt_ids) + 1)[-seq_len:]
+                inputs = {
+                    "input_ids": input_ids.unsqueeze(0),
+                    "attention_mask": torch.ones(1, seq_len, dtype=torch.long)
+                }
+                with self._generate_lock, torch.inference_mode():
+                    self.model.generate(
+                        **self._to_device(inputs),
+                        **self._generation_kwargs(max_new_tokens=4)
+                    )
+        except Exception as e:
+            # A failed warmup only costs first-request latency, not correctness
+            logger.warning("⚠️ Warmup failed: %s", e)
+            return
+        logger.info("✅ Warmup done in %.1fs (prompt lengths: %s)", time.perf_counter() - start, seq_lens)
+    
     def is_model_loaded(self) -> bool:
         """Check if model is ready"""
         return self.model_loaded and self.model is not None
     
-    def get_session_history(self, session_id: str) -> SimpleChatHistory:
+    def _on_session_evicted(self, session_id: str, history: BoundedChatHistory) -> None:
+        """Release everything held for a session dropped by TTL or capacity"""
+        self._session_items.pop(session_id, None)
+        if self._session_kv_store:
+            # Snapshot it off the event loop; its blocks are released once written
+            self._evicted[session_id] = (list(history), history.created_at)
+            self._schedule_snapshot(session_id)
+        else:
+            self._kv_cache.evict_session(session_id)
+        # A request still inside a turn for this session holds the object: don't reuse it
+        if session_id not in self._session_locks:
+            self._recycle_history(history)
+        logger.info("⏳ Evicted idle session: %s", session_id)
+    
+    def _schedule_snapshot(self, session_id: str) -> None:
+        """Write an evicted session's snapshot in the background"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop in this thread (shutdown, scripts): write it right here
+            self._write_evicted(session_id)
+            return
+        task = loop.create_task(self._snapshot_evicted(session_id))
+        self._snapshot_tasks.add(task)
+        task.add_done_callback(self._snapshot_tasks.discard)
+    
+    async def _snapshot_evicted(self, session_id: str) -> None:
+        # Under the session lock, a returning request waits for the file instead of racing it
+        async with self._session_lock(session_id):
+            await asyncio.to_thread(self._write_evicted, session_id)
+    
+    def _write_evicted(self, session_id: str) -> None:
+        """Persist an evicted session and release its KV (no-op if revived or deleted meanwhile)"""
+        evicted = self._evicted.pop(session_id, None)
+        if evicted is None:
+            return
+        self._persist_session_kv(session_id, *evicted)
+        self._kv_cache.evict_session(session_id)
+    
+    def get_session_history(self, session_id: str) -> BoundedChatHistory:
         """Get or create session history"""
-        if session_id not in self.session_store:
-            self.session_store[session_id] = SimpleChatHistory()
-            self.session_created[session_id] = datetime.now().isoformat()
-            logger.info(f"📝 Created new session: {session_id}")
-        return self.session_store[session_id]
-    
-    def _format_conversation(self, history: SimpleChatHistory, prompt: str) -> List[Dict[str, str]]:
-        """Format conversation for Qwen"""
-        messages = []
-        
-        # Add system message for world history
-        messages.append({
-            "role": "system",
-            "content": "You are a knowledgeable world history expert. Provide accurate, detailed, and engaging historical information."
-        })
-        
-        # Add history
-        for msg in history.messages:
-            messages.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-        
-        # Add current prompt
-        messages.append({"role": "user", "content": prompt})
-        
-        # Limit history
-        max_messages = settings.MAX_HISTORY_LENGTH * 2 + 1  # +1 for system message
-        if len(messages) > max_messages:
-            # Keep system message and most recent history
-            system_msg = messages[0]
-            recent_msgs = messages[-(max_messages-1):]
-            messages = [system_msg] + recent_msgs
-            logger.debug(f"Trimmed to {len(messages)} messages")
-        
-        logger.debug(f"Formatted {len(messages)} messages for model")
-        return messages
-    
-    def _generate_response(self, messages: List[Dict[str, str]]) -> str:
-        """Generate AI response"""
+        history = self.session_store.get(session_id)
+        if history is not None:
+            # Re-insert to restart the idle TTL of an active session
+            self.session_store[session_id] = history
+            return history
+        
+        # Purge expired entries first: this very session may be among them,
+        # and it must be snapshotted before we look for its snapshot
+        self.session_store.expire()
+        
+        on_change = partial(self._on_history_changed, session_id)
+        if self._history_pool:
+            history = self._history_pool.pop()
+            history.reset(on_change=on_change)
+        else:
+            history = BoundedChatHistory(
+                max_turns=settings.MAX_HISTORY_LENGTH,
+                char_cap=settings.MAX_HISTORY_CHARS,
+                on_change=on_change
+            )
+        
+        evicted = self._evicted.pop(session_id, None)
+        restored = None
+        if evicted is None and self._session_kv_store:
+            restored = self._session_kv_store.load(session_id)
+        if evicted is not None:
+            # Not written out yet: messages and bound KV are still in memory
+            messages, history.created_at = evicted
+            for message in messages:
+                history.append(message)
+            logger.info("♻️ Revived session %s: %s messages", session_id, len(history))
+        elif restored is not None:
+            prefix_ids, pairs, meta = restored
+            for msg in meta.get("messages", []):
+                history.append(ChatMessage(msg["role"], msg["content"]))
+            history.created_at = meta.get("created_at", history.created_at)
+            self._kv_cache.insert(prefix_ids, pairs)
+            self._kv_cache.bind_session(session_id, prefix_ids)
+            logger.info("♻️ Restored session %s: %s messages, %s cached tokens", session_id, len(history), len(prefix_ids))
+        else:
+            logger.info("📝 Created new session: %s", session_id)
+        
+        self.session_store[session_id] = history
+        # Trusted internal data: model_construct skips validation
+        self._session_items[session_id] = SessionListItem.model_construct(
+            session_id=session_id, message_count=len(history)
+        )
+        return history
+    
+    def _recycle_history(self, history: BoundedChatHistory) -> None:
+        """Return a dropped session's history to the pool"""
+        if len(self._history_pool) < settings.HISTORY_POOL_SIZE:
+            history.reset()
+            self._history_pool.append(history)
+    
+    def _on_history_changed(self, session_id: str, message_count: int) -> None:
+        """Keep the /sessions entry of a session in step with its history"""
+        item = self._session_items.get(session_id)
+        if item is not None:
+            item.message_count = message_count
+    
+    def _apply_template(self, messages: List[Dict[str, str]], add_generation_prompt: bool = False) -> torch.Tensor:
+        """Tokenize messages with the model's chat template"""
+        ids = self.tokenizer.apply_chat_template(
+            messages,
+            tokenize=True,
+            add_generation_prompt=add_generation_prompt,
+            return_dict=False
+        )
+        return torch.tensor(ids, dtype=torch.long)
+    
+    def _encode_message(self, role: str, content: str) -> torch.Tensor:
+        """
+        Token IDs of a single chat turn
+        Rendered after the system turn (so templates don't inject their
+        default system prompt); only the text past the cached system turn
+        goes through the tokenizer.
+        """
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": role, "content": content}
+        ]
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False)
+        if not text.startswith(self._sys_text):
+            return self._apply_template(messages)[len(self._sys_ids):]
+        ids = self.tokenizer(
+            text[len(self._sys_text):],
+            add_special_tokens=False,
+            return_tensors="np"
+        )["input_ids"][0]
+        return torch.from_numpy(ids)
+    
+    def _message_ids(self, message: ChatMessage) -> torch.Tensor:
+        """Cached token IDs of a history message"""
+        if message.token_ids is None:
+            message.token_ids = self._encode_message(message.role, message.content)
+        return message.token_ids
+    
+    def _build_input_ids(self, history: BoundedChatHistory, prompt_ids: torch.Tensor) -> torch.Tensor:
+        """
+        Assemble the prompt from cached per-message token IDs
+        Only the new user turn is tokenized per request. History is already
+        bounded by BoundedChatHistory; on top of that the oldest messages are dropped
+        once the prompt would exceed MAX_INPUT_TOKENS.
+        """
+        budget = (
+            settings.MAX_INPUT_TOKENS
+            - len(self._sys_ids) - len(prompt_ids) - len(self._gen_prompt_ids)
+        )
+        
+        window: List[torch.Tensor] = []
+        for message in reversed(history):
+            ids = self._message_ids(message)
+            if len(ids) > budget:
+                break
+            window.append(ids)
+            budget -= len(ids)
+        window.reverse()
+        
+        if len(window) < len(history):
+            logger.debug("Sliding window kept %s/%s messages", len(window), len(history))
+        
+        return torch.cat([self._sys_ids, *window, prompt_ids, self._gen_prompt_ids])
+    
+    def _generate_response(
+        self,
+        input_ids: torch.Tensor,
+        streamer: Optional[TextStreamer] = None,
+        max_new_tokens: Optional[int] = None,
+        cancel: Optional[threading.Event] = None
+    ) -> str:
+        """
+        Generate AI response (tokens are also pushed to streamer if given)
+        Setting cancel stops generation early; the partial response is returned.
+        """
         try:
             logger.debug("🤔 Generating response...")
             
-            # Apply chat template
-            text = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
+            input_length = len(input_ids)
+            logger.debug("Input tokens: %s", input_length)
             
-            logger.debug(f"Prompt length: {len(text)} chars")
+            inputs = {
+                "input_ids": input_ids.unsqueeze(0),
+                "attention_mask": torch.ones(1, input_length, dtype=torch.long)
+            }
             
-            # Tokenize
-            inputs = self.tokenizer(
-                text,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=2048
-            ).to(self.device)
+            # Reuse KV of the longest cached prefix (system prompt + history).
+            # Not with TORCH_COMPILE: the static cache can't be seeded with a prefix.
+            use_prefix_cache = settings.KV_CACHE_ENABLED and not settings.TORCH_COMPILE
+            past_key_values = None
+            if use_prefix_cache:
+                past_key_values, cached_tokens = self._kv_cache.lookup(input_ids)
+                logger.debug("Reusing %s cached prefix tokens", cached_tokens)
             
-            input_length = inputs['input_ids'].shape[1]
-            logger.debug(f"Input tokens: {input_length}")
+            generation_kwargs = self._generation_kwargs(self._max_new_tokens(input_length, max_new_tokens))
+            if cancel is not None:
+                generation_kwargs["stopping_criteria"] = StoppingCriteriaList([CancelCriteria(cancel)])
             
             # Generate
-            with torch.no_grad():
+            with self._generate_lock, torch.inference_mode():
+                if cancel is not None and cancel.is_set():
+                    # Cancelled while waiting for the model: don't start at all
+                    return ""
                 outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=settings.MAX_TOKENS,
-                    temperature=settings.TEMPERATURE,
-                    top_p=settings.TOP_P,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    repetition_penalty=1.1
+                    **self._to_device(inputs),
+                    past_key_values=past_key_values,
+                    return_dict_in_generate=True,
+                    streamer=streamer,
+                    **generation_kwargs
                 )
             
+            if use_prefix_cache and outputs.past_key_values is not None:
+                self._kv_cache.store(input_ids, outputs.past_key_values)
+            
             # Extract only the generated tokens
-            generated_ids = outputs[0][input_length:]
-            response = self.tokenizer.decode(
-                generated_ids, 
-                skip_special_tokens=True
-            ).strip()
+            return self._decode_response(outputs.sequences[0][input_length:])
+            
+        except Exception as e:
+            logger.error("❌ Generation error: %s", e)
+            if streamer is not None:
+                # Unblock the consumer; generate() only ends the stream on success
+                streamer.end()
+            raise RuntimeError(f"Failed to generate response: {str(e)}")
+    
+    def _generate_batch(self, batch: List[torch.Tensor], max_new_tokens: List[Optional[int]]) -> List[str]:
+        """Generate responses for several prompts in one left-padded generate call"""
+        try:
+            logger.debug("🤔 Generating batch of %s responses...", len(batch))
             
-            logger.debug(f"Generated response: {len(response)} chars")
+            # Left padding keeps every prompt flush against its generated tokens
+            inputs = self.tokenizer.pad(
+                {"input_ids": [input_ids.tolist() for input_ids in batch]},
+                padding=True,
+                return_tensors="pt"
+            )
+            input_length = inputs['input_ids'].shape[1]
+            logger.debug("Batch input tokens (padded): %s", input_length)
             
-            # Validation
-            if not response or len(response) < 5:
-                logger.warning("Generated response too short, using fallback")
-                return "I apologize, but I couldn't generate a proper response. Please try rephrasing your question."
+            # Generate up to the largest per-request limit, then trim each row to its own
+            limits = [self._max_new_tokens(input_length, n) for n in max_new_tokens]
+            with self._generate_lock, torch.inference_mode():
+                outputs = self.model.generate(
+                    **self._to_device(dict(inputs)),
+                    **self._generation_kwargs(max(limits))
+                )
             
-            logger.debug(f"Final response length: {len(response)} chars")
-            return response
+            # One batch_decode call for every row instead of a decode per row
+            responses = self.tokenizer.batch_decode(
+                [row[input_length:input_length + limit].tolist() for row, limit in zip(outputs, limits)],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False
+            )
+            return [self._finalize_response(response) for response in responses]
             
         except Exception as e:
-            logger.error(f"❌ Generation error: {str(e)}")
+            logger.error("❌ Batch generation error: %s", e)
             raise RuntimeError(f"Failed to generate response: {str(e)}")
     
-    async def chat(self, prompt: str, session_id: str) -> str:
-        """Main chat method"""
-        if not self.is_model_loaded():
-            raise RuntimeError(
-                "Model is not loaded. Please check server logs. "
-                "The model should load automatically on startup."
+    def _max_new_tokens(self, input_length: int, requested: Optional[int] = None) -> int:
+        """Per-request token limit, capped by MAX_TOKENS and the room left in the context"""
+        limit = min(requested or settings.MAX_TOKENS, settings.MAX_TOKENS)
+        return max(1, min(limit, settings.MAX_CONTEXT_TOKENS - input_length))
+    
+    def _generation_kwargs(self, max_new_tokens: Optional[int] = None) -> Dict:
+        """Sampling parameters shared by single and batched generation"""
+        kwargs = {
+            "max_new_tokens": max_new_tokens or settings.MAX_TOKENS,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+            "repetition_penalty": 1.1,
+            # Matches whole multi-token stop strings, not just their first token
+            "stop_strings": STOP_STRINGS,
+            "tokenizer": self.tokenizer
+        }
+        
+        # Near-zero temperature is effectively argmax: skip the sampling step
+        if settings.TEMPERATURE <= 0.1:
+            kwargs.update(do_sample=False, temperature=None, top_p=None)
+        else:
+            kwargs.update(do_sample=True, temperature=settings.TEMPERATURE, top_p=settings.TOP_P)
+        
+        # Compiled forward wants fixed shapes: preallocate the KV cache once
+        if settings.TORCH_COMPILE:
+            kwargs["cache_implementation"] = "static"
+        return kwargs
+    
+    def _decode_response(self, generated_ids: torch.Tensor) -> str:
+        """Decode generated tokens, falling back when the output is unusable"""
+        response = self.tokenizer.decode(
+            generated_ids.tolist(),
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False
+        )
+        return self._finalize_response(response)
+    
+    def _finalize_response(self, response: str) -> str:
+        """Strip a decoded response and replace it if it is unusable"""
+        for stop in STOP_STRINGS:
+            response = response.partition(stop)[0]
+        response = response.strip()
+        
+        logger.debug("Generated response: %s chars", len(response))
+        
+        # Validation
+        if len(response) < MIN_RESPONSE_CHARS:
+            logger.warning("Generated response too short, using fallback")
+            return FALLBACK_RESPONSE
+        
+        logger.debug("Final response length: %s chars", len(response))
+        return response
+    
+    def start_batch_worker(self) -> None:
+        """Start the background batching task (must run inside the event loop)"""
+        self._batcher.start()
+    
+    async def stop_batch_worker(self) -> None:
+        """Cancel the background batching task"""
+        await self._batcher.stop()
+    
+    def close(self) -> None:
+        """Persist sessions and release resources kept outside the process heap (call at shutdown)"""
+        self.persist_sessions()
+        self._kv_cache.close()
+    
+    def _persist_session_kv(self, session_id: str, messages: List[ChatMessage], created_at: str) -> None:
+        """Snapshot a session's cached prefix KV and messages to the mmap store"""
+        try:
+            prefix_ids, pairs = self._kv_cache.session_prefix(session_id)
+            if pairs is None:
+                return
+            self._session_kv_store.save(
+                session_id,
+                prefix_ids,
+                pairs,
+                {
+                    "messages": [{"role": m.role, "content": m.content} for m in messages],
+                    "created_at": created_at
+                }
             )
+        except Exception as e:
+            logger.warning("⚠️ Failed to persist KV for session %s: %s", session_id, e)
+    
+    def persist_sessions(self) -> None:
+        """
+        Snapshot every live session to the mmap store (call at shutdown)
+        Sessions are otherwise only written when TTL or capacity evicts them,
+        so turns never pay for rewriting the whole prefix KV.
+        """
+        if not self._session_kv_store:
+            return
+        self.session_store.expire()
+        # Evictions whose background write has not run yet
+        for session_id in list(self._evicted):
+            self._write_evicted(session_id)
+        sessions = list(self.session_store.items())
+        for session_id, history in sessions:
+            self._persist_session_kv(session_id, list(history), history.created_at)
+        logger.info("💾 Persisted KV of %s sessions", len(sessions))
+    
+    def _session_lock(self, session_id: str) -> asyncio.Lock:
+        """Lock serializing turns of one session (read history -> generate -> append)"""
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        return lock
+    
+    async def chat(self, prompt: str, session_id: str, max_new_tokens: Optional[int] = None) -> str:
+        """Main chat method (max_new_tokens caps this reply below MAX_TOKENS)"""
+        if not self.is_model_loaded():
+            raise RuntimeError(MODEL_NOT_LOADED_MESSAGE)
         
-        logger.info(f"💬 Chat request - Session: {session_id}")
-        logger.info(f"📝 Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
+        logger.info("💬 Chat request - Session: %s", session_id)
+        logger.info("📝 Prompt: %s%s", prompt[:100], '...' if len(prompt) > 100 else '')
         
         try:
-            # Get history
-            history = self.get_session_history(session_id)
-            
-            # Format messages
-            messages = self._format_conversation(history, prompt)
-            
-            # Generate response
-            response = self._generate_response(messages)
-            
-            # Update history
-            history.add_user_message(prompt)
-            history.add_ai_message(response)
-            
-            logger.info(f"✅ Response generated: {len(response)} chars")
-            logger.info(f"📊 Session now has {len(history)} messages")
+            # One turn at a time per session; other sessions are not blocked
+            async with self._session_lock(session_id):
+                # Get history
+                history = self.get_session_history(session_id)
+                
+                # Tokenize only the new turn; history IDs are cached per message
+                prompt_ids = self._encode_message("user", prompt)
+                input_ids = self._build_input_ids(history, prompt_ids)
+                
+                # Generate response (through the batch queue when the worker is running)
+                if self._batcher.running:
+                    response = await self._batcher.submit(input_ids, max_new_tokens)
+                else:
+                    response = await asyncio.to_thread(
+                        self._generate_response, input_ids, max_new_tokens=max_new_tokens
+                    )
+                
+                self._complete_turn(session_id, history, prompt, prompt_ids, input_ids, response)
+                return response
             
-            return response
+        except Exception as e:
+            logger.error("❌ Chat error: %s", e)
+            raise
+    
+    async def chat_stream(
+        self,
+        prompt: str,
+        session_id: str,
+        max_new_tokens: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """Streaming chat method: yields response text as it is generated"""
+        if not self.is_model_loaded():
+            raise RuntimeError(MODEL_NOT_LOADED_MESSAGE)
+        
+        logger.info("💬 Stream request - Session: %s", session_id)
+        logger.info("📝 Prompt: %s%s", prompt[:100], '...' if len(prompt) > 100 else '')
+        
+        try:
+            async with self._session_lock(session_id):
+                history = self.get_session_history(session_id)
+                prompt_ids = self._encode_message("user", prompt)
+                input_ids = self._build_input_ids(history, prompt_ids)
+                
+                # generate() runs in a worker thread and hands chunks to the loop
+                loop = asyncio.get_running_loop()
+                chunks: asyncio.Queue = asyncio.Queue()
+                streamer = IncrementalTextStreamer(
+                    self.tokenizer,
+                    on_text=partial(loop.call_soon_threadsafe, chunks.put_nowait),
+                    skip_prompt=True,
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False
+                )
+                cancel = threading.Event()
+                generation = loop.run_in_executor(
+                    None, partial(self._generate_response, input_ids, streamer, max_new_tokens, cancel)
+                )
+                
+                try:
+                    # Only text certain to start the final response is sent (no stop strings)
+                    generated = ""
+                    streamed = ""
+                    while True:
+                        text = await chunks.get()
+                        if text is None:
+                            break
+                        generated += text
+                        safe = streamable_prefix(generated)
+                        if len(safe) > len(streamed):
+                            yield safe[len(streamed):]
+                            streamed = safe
+                    
+                    # History only gets the complete (validated) response
+                    response = await generation
+                    if not response.startswith(streamed):
+                        logger.warning("Streamed text diverged from the final response of %s", session_id)
+                    elif len(response) > len(streamed):
+                        # Held-back tail, or the fallback if nothing was usable
+                        yield response[len(streamed):]
+                    self._complete_turn(session_id, history, prompt, prompt_ids, input_ids, response)
+                finally:
+                    # Client gone or stream failed: free the model instead of generating to MAX_TOKENS
+                    cancel.set()
             
         except Exception as e:
-            logger.error(f"❌ Chat error: {str(e)}")
+            logger.error("❌ Chat stream error: %s", e)
             raise
     
-    def clear_history(self, session_id: str) -> None:
-        """Clear session history"""
-        if session_id in self.session_store:
-            self.session_store[session_id].clear()
-            logger.info(f"🗑️ Cleared history: {session_id}")
+    def _complete_turn(
+        self,
+        session_id: str,
+        history: BoundedChatHistory,
+        prompt: str,
+        prompt_ids: torch.Tensor,
+        input_ids: torch.Tensor,
+        response: str
+    ) -> None:
+        """Record a finished turn in the session history and KV bookkeeping"""
+        if self.try_get(session_id) is not history:
+            # Evicted mid-turn: don't resurrect its KV refs or persisted files
+            logger.info("⏳ Session %s was evicted during the turn, not recording it", session_id)
+            return
+        history.add_user_message(prompt, prompt_ids)
+        history.add_ai_message(response, self._encode_message("assistant", response))
+        self._kv_cache.bind_session(session_id, input_ids)
+        
+        logger.info("✅ Response generated: %s chars", len(response))
+        logger.info("📊 Session now has %s messages", len(history))
+    
+    def try_get(self, session_id: str) -> Optional[BoundedChatHistory]:
+        """History of a live session, or None: one lookup for check-then-read callers"""
+        return self.session_store.get(session_id)
     
-    def delete_session(self, session_id: str) -> None:
-        """Delete session"""
-        if session_id in self.session_store:
-            del self.session_store[session_id]
-            if session_id in self.session_created:
-                del self.session_created[session_id]
-            logger.info(f"🗑️ Deleted session: {session_id}")
+    async def clear_history(self, session_id: str) -> bool:
+        """
+        Clear session history (in place: the history object is reused)
+        Waits for an in-flight turn of the session, which would otherwise
+        re-append to the history after the clear. Returns False if the
+        session exists neither in memory nor on disk.
+        """
+        async with self._session_lock(session_id):
+            # An idle session past its TTL is evicted here, so its snapshot is dropped below
+            self.session_store.expire()
+            history = self.try_get(session_id)
+            evicted = self._evicted.pop(session_id, None)
+            if history is not None:
+                history.clear()
+            self._kv_cache.evict_session(session_id)
+            on_disk = bool(self._session_kv_store and self._session_kv_store.delete(session_id))
+            if history is None and evicted is None and not on_disk:
+                return False
+        logger.info("🗑️ Cleared history: %s", session_id)
+        return True
+    
+    async def delete_session(self, session_id: str) -> bool:
+        """
+        Delete session after any in-flight turn
+        Always drops its KV and snapshot files; returns False if nothing existed.
+        """
+        async with self._session_lock(session_id):
+            self.session_store.expire()
+            history = self.session_store.pop(session_id, None)
+            evicted = self._evicted.pop(session_id, None)
+            self._session_items.pop(session_id, None)
+            self._kv_cache.evict_session(session_id)
+            on_disk = bool(self._session_kv_store and self._session_kv_store.delete(session_id))
+            if history is not None:
+                # Turns fetch the history under this lock, so no one else holds it
+                self._recycle_history(history)
+            if history is None and evicted is None and not on_disk:
+                return False
+        logger.info("🗑️ Deleted session: %s", session_id)
+        return True
+    
+    def get_history_length(self, session_id: str) -> int:
+        """Message count of a session in O(1): one lookup, no copy of the messages"""
+        history = self.try_get(session_id)
+        return 0 if history is None else len(history)
     
     def get_message_count(self, session_id: str) -> int:
         """Get message count"""
-        if session_id not in self.session_store:
-            return 0
-        return len(self.session_store[session_id])
+        return self.get_history_length(session_id)
     
     def session_exists(self, session_id: str) -> bool:
         """Check if session exists"""
-        return session_id in self.session_store
+        return self.try_get(session_id) is not None
     
     def get_active_sessions_count(self) -> int:
         """Get active session count"""
-        return len(self.session_store)
+        self.session_store.expire()
+        return len(self._session_items)
     
-    def get_all_sessions(self) -> List[Dict]:
+    def get_all_sessions(self) -> List[SessionListItem]:
         """Get all sessions"""
-        sessions = []
-        for session_id in self.session_store.keys():
-            sessions.append({
-                "session_id": session_id,
-                "message_count": self.get_message_count(session_id)
-            })
-        return sessions
+        self.session_store.expire()
+        return list(self._session_items.values())
     
     def get_session_created_time(self, session_id: str) -> str:
         """Get session creation time"""
-        return self.session_created.get(session_id, datetime.now().isoformat())
+        history = self.try_get(session_id)
+        if history is None:
+            return now_iso()
+        return history.created_at
 
 
-# ============================================================================
-# GLOBAL INSTANCE INITIALIZATION
-# ============================================================================
-
-logger.info("🔨 Initializing global chat_service instance...")
+@lru_cache(maxsize=1)
+def get_chat_service() -> ChatService:
+    """
+    Process-wide ChatService, built on first call
+    
+    Nothing is constructed at import time; a failed load is not cached, so
+    the next call retries.
+    """
+    return ChatService()
 
-try:
-    chat_service = ChatService()
-    if chat_service.is_model_loaded():
-        logger.info("🎉 Global chat_service ready!")
-    else:
-        logger.error("⚠️ chat_service created but model not loaded!")
-        chat_service = None
-except Exception as e:
-    logger.error("="*70)
-    logger.error("❌ CRITICAL: Failed to initialize chat_service")
-    logger.error(f"Error: {str(e)}")
-    logger.error("="*70)
-    logger.error("The server will start but chat endpoints will not work!")
-    logger.error("Please check the errors above and fix the issue.")
-    logger.error("="*70)
-    chat_service = None
 
 # Export
-__all__ = ['chat_service', 'ChatService']
\ No newline at end of file
+__all__ = ['ChatService', 'get_chat_service']
@@ -0,0 +1,489 @@
+"""
+Prefix KV-Cache Reuse
+Keeps past_key_values for already-seen prompt prefixes so each chat turn
+only prefills the tokens that were appended since the previous turn.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+# Per-layer (key, value) tensors shaped [batch, kv_heads, seq_len, head_dim]
+KVPairs = List[Tuple[torch.Tensor, torch.Tensor]]
+
+# Cold-tier block files: hex of the 16-byte block key
+_COLD_FILE = re.compile(r"[0-9a-f]{32}\.pt")
+
+
+def cache_to_tensors(cache) -> KVPairs:
+    """Extract per-layer (key, value) tensors from a transformers cache"""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def cache_from_tensors(pairs: KVPairs) -> DynamicCache:
+    """Build a fresh DynamicCache seeded with per-layer tensors"""
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(pairs):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+class PrefixKVCache:
+    """
+    Content-addressed store of prompt-prefix KV blocks
+    KV is split into fixed-size token blocks keyed by a chained blake2b hash
+    (hash of the block's tokens plus the previous block's hash), so a key
+    identifies the whole prefix up to that block. Sessions that share a
+    prefix - the system prompt above all - share its blocks instead of
+    holding their own copies; each session refcounts the blocks it uses.
+
+    The hot tier keeps blocks on the model device. When it is full, the block
+    with the lowest GreedyDual priority (clock + hits) is demoted; a hit on a
+    block also hits all its ancestors, so leaves go before shared roots.
+    With cold_dir set, demoted blocks are written as .pt files (LRU,
+    max_cold_blocks) to a per-process subdirectory and promoted back on a hit.
+    Workers can share cold_dir this way: each indexes and deletes only its own
+    files. The index is not persisted, so leftovers under the same pid are
+    removed on start and close() removes the subdirectory.
+    """
+
+    def __init__(
+        self,
+        block_size: int = 128,
+        max_blocks: int = 256,
+        cold_dir: Optional[str] = None,
+        max_cold_blocks: int = 1024
+    ):
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self._blocks: Dict[bytes, KVPairs] = {}
+        self._depth: Dict[bytes, int] = {}
+        # GreedyDual state: hit counts, priorities and the aging clock
+        self._hits: Dict[bytes, int] = {}
+        self._priority: Dict[bytes, float] = {}
+        self._clock = 0.0
+        # Cold tier: key -> (hits, depth, device) of blocks spilled to disk
+        self.cold_dir = os.path.join(cold_dir, f"worker-{os.getpid()}") if cold_dir else None
+        self.max_cold_blocks = max_cold_blocks
+        self._cold: "OrderedDict[bytes, Tuple[int, int, str]]" = OrderedDict()
+        if self.cold_dir:
+            os.makedirs(self.cold_dir, exist_ok=True)
+            self._clear_cold_dir()
+        # Session -> block chain of its latest prompt; blocks are refcounted
+        self._session_index: Dict[str, List[bytes]] = {}
+        self._session_ids: Dict[str, torch.Tensor] = {}
+        self._block_refs: Dict[bytes, int] = {}
+        # Generation threads and the event loop both touch the cache
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _block_hashes(self, input_ids: torch.Tensor) -> List[bytes]:
+        """Chained hash of every full block, hashes[i] covers blocks 0..i"""
+        ids = input_ids.detach().to("cpu", torch.int64).numpy()
+        hashes = []
+        digest = b""
+        for start in range(0, len(ids) - self.block_size + 1, self.block_size):
+            block = ids[start:start + self.block_size].tobytes()
+            digest = hashlib.blake2b(block + digest, digest_size=16).digest()
+            hashes.append(digest)
+        return hashes
+
+    def _chain(self, input_ids: torch.Tensor, max_tokens: Optional[int] = None) -> List[bytes]:
+        """Keys of the longest run of cached blocks (either tier) from the start"""
+        if max_tokens is None:
+            max_tokens = len(input_ids)
+        chain = []
+        for key in self._block_hashes(input_ids)[:max_tokens // self.block_size]:
+            if key not in self._blocks and key not in self._cold:
+                break
+            chain.append(key)
+        return chain
+
+    def longest_prefix(
+        self,
+        input_ids: torch.Tensor,
+        max_tokens: Optional[int] = None
+    ) -> Tuple[torch.Tensor, Optional[KVPairs]]:
+        """
+        Find the longest cached prefix of a 1-D prompt (up to max_tokens)
+
+        Returns:
+            (prefix_ids, pairs) - pairs is None on a miss
+        """
+        with self._lock:
+            pieces = []
+            for key in self._chain(input_ids, max_tokens):
+                if key in self._blocks:
+                    self._touch(key)
+                    pairs = self._blocks[key]
+                else:
+                    pairs = self._promote(key)
+                    if pairs is None:
+                        break
+                pieces.append(pairs)
+            if not pieces:
+                return input_ids[:0], None
+            return input_ids[:len(pieces) * self.block_size], self._concat(pieces)
+
+    @staticmethod
+    def _concat(pieces: List[KVPairs]) -> KVPairs:
+        """Join per-block tensors into one (key, value) pair per layer"""
+        if len(pieces) == 1:
+            return pieces[0]
+        return [
+            (
+                torch.cat([piece[layer][0] for piece in pieces], dim=2),
+                torch.cat([piece[layer][1] for piece in pieces], dim=2)
+            )
+            for layer in range(len(pieces[0]))
+        ]
+
+    def lookup(self, input_ids: torch.Tensor) -> Tuple[Optional[DynamicCache], int]:
+        """
+        Find the longest cached prefix of a 1-D prompt as a ready DynamicCache
+
+        Returns:
+            (cache, cached_tokens) - cache is None on a miss. At least one
+            prompt token is always left uncached so generate() has input.
+        """
+        prefix_ids, pairs = self.longest_prefix(input_ids, max_tokens=len(input_ids) - 1)
+        if pairs is None:
+            logger.debug("KV prefix miss: %s tokens", len(input_ids))
+            return None, 0
+        logger.debug("KV prefix hit: %s/%s tokens", len(prefix_ids), len(input_ids))
+        return cache_from_tensors(pairs), len(prefix_ids)
+
+    def store(self, input_ids: torch.Tensor, cache) -> None:
+        """Store the full prompt blocks of a post-generation cache"""
+        with self._lock:
+            self._add_blocks(self._block_hashes(input_ids), lambda: cache_to_tensors(cache), copy=True)
+
+    def insert(self, prefix_ids: torch.Tensor, pairs: KVPairs) -> None:
+        """Insert already block-aligned prefix tensors (e.g. restored from disk)"""
+        with self._lock:
+            hashes = self._block_hashes(prefix_ids)
+            if len(hashes) * self.block_size == len(prefix_ids):
+                # Views, not copies: memory-mapped tensors stay file-backed
+                self._add_blocks(hashes, lambda: pairs, copy=False)
+
+    def _add_blocks(self, hashes: List[bytes], get_tensors, copy: bool) -> None:
+        """Store the blocks that aren't cached yet; shared blocks are only touched"""
+        tensors = None
+        added = 0
+        for depth, key in enumerate(hashes):
+            if key in self._blocks:
+                self._touch(key)
+                continue
+            # Fresh tensors are at hand, so they replace an offloaded copy
+            self._drop_cold(key)
+            if tensors is None:
+                tensors = get_tensors()
+            start = depth * self.block_size
+            end = start + self.block_size
+            pairs = [(keys[:, :, start:end], values[:, :, start:end]) for keys, values in tensors]
+            if copy:
+                # Don't keep the whole generation cache alive through a slice
+                pairs = [(keys.clone(), values.clone()) for keys, values in pairs]
+            self._insert(key, pairs, depth)
+            added += 1
+        if added:
+            logger.debug("KV blocks stored: %s new of %s (%s cached)", added, len(hashes), len(self._blocks))
+
+    def _insert(self, key: bytes, pairs: KVPairs, depth: int, hits: int = 1) -> None:
+        self._blocks[key] = pairs
+        self._depth[key] = depth
+        self._hits[key] = hits - 1
+        self._touch(key)
+        while len(self._blocks) > self.max_blocks:
+            # Ties go to the deepest block so chains shrink from the tail
+            self._demote(min(self._blocks, key=lambda k: (self._priority[k], -self._depth[k])))
+
+    def _touch(self, key: bytes) -> None:
+        """Count a hit and refresh the GreedyDual priority of a hot block"""
+        self._hits[key] += 1
+        self._priority[key] = self._clock + self._hits[key]
+
+    def _cold_path(self, key: bytes) -> str:
+        return os.path.join(self.cold_dir, f"{key.hex()}.pt")
+
+    def _demote(self, key: bytes) -> None:
+        """Move a hot block to the cold tier (or drop it if there is none)"""
+        # Aging: later blocks must out-earn the priority of what was just evicted
+        self._clock = self._priority.pop(key)
+        pairs = self._blocks.pop(key)
+        hits = self._hits.pop(key)
+        depth = self._depth.pop(key)
+        if not self.cold_dir:
+            return
+        try:
+            torch.save([(k.cpu(), v.cpu()) for k, v in pairs], self._cold_path(key))
+        except Exception as e:
+            logger.warning("⚠️ Could not offload KV block to disk: %s", e)
+            return
+        self._cold[key] = (hits, depth, str(pairs[0][0].device))
+        while len(self._cold) > self.max_cold_blocks:
+            self._drop_cold(next(iter(self._cold)))
+        logger.debug("KV block offloaded (%s cold)", len(self._cold))
+
+    def _clear_cold_dir(self) -> None:
+        """Remove blocks left by an earlier process with this pid: the cold index is in-memory only"""
+        removed = 0
+        for name in os.listdir(self.cold_dir):
+            if _COLD_FILE.fullmatch(name):
+                os.remove(os.path.join(self.cold_dir, name))
+                removed += 1
+        if removed:
+            logger.info("🧹 Removed %s stale offloaded KV blocks from %s", removed, self.cold_dir)
+
+    def _load_cold(self, key: bytes) -> Optional[KVPairs]:
+        """Read a cold block onto its device without changing either tier"""
+        try:
+            return torch.load(self._cold_path(key), map_location=self._cold[key][2])
+        except Exception as e:
+            logger.warning("⚠️ Could not load offloaded KV block: %s", e)
+            return None
+
+    def _promote(self, key: bytes) -> Optional[KVPairs]:
+        """Load a cold block back onto its device; None if the file is unusable"""
+        hits, depth, _ = self._cold[key]
+        pairs = self._load_cold(key)
+        self._drop_cold(key)
+        if pairs is None:
+            return None
+        self._insert(key, pairs, depth, hits=hits + 1)
+        logger.debug("KV block promoted")
+        return pairs
+
+    def _drop_cold(self, key: bytes) -> None:
+        if self._cold.pop(key, None) is None:
+            return
+        path = self._cold_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _drop(self, key: bytes) -> bool:
+        """Remove a block from both tiers"""
+        dropped = key in self._blocks or key in self._cold
+        if self._blocks.pop(key, None) is not None:
+            del self._depth[key], self._hits[key], self._priority[key]
+        self._drop_cold(key)
+        return dropped
+
+    def bind_session(self, session_id: str, input_ids: torch.Tensor) -> None:
+        """Point a session at the cached blocks of its latest prompt"""
+        with self._lock:
+            chain = self._chain(input_ids)
+            old_chain = self._session_index.get(session_id, [])
+            if not chain or chain == old_chain:
+                return
+            for key in chain:
+                self._block_refs[key] = self._block_refs.get(key, 0) + 1
+            for key in old_chain:
+                self._release(key)
+            self._session_index[session_id] = chain
+            self._session_ids[session_id] = input_ids[:len(chain) * self.block_size]
+
+    def session_prefix(self, session_id: str) -> Tuple[torch.Tensor, Optional[KVPairs]]:
+        """
+        Cached prefix KV of a session's latest prompt, for snapshots
+        Unlike longest_prefix this is not a hit: GreedyDual counts are left
+        alone and cold blocks are read without being promoted.
+
+        Returns:
+            (prefix_ids, pairs) - pairs is None if nothing is cached
+        """
+        with self._lock:
+            pieces = []
+            for key in self._session_index.get(session_id, []):
+                if key in self._blocks:
+                    pairs = self._blocks[key]
+                elif key in self._cold:
+                    pairs = self._load_cold(key)
+                    if pairs is None:
+                        break
+                else:
+                    break
+                pieces.append(pairs)
+            if not pieces:
+                return torch.empty(0, dtype=torch.long), None
+            prefix_ids = self._session_ids[session_id][:len(pieces) * self.block_size]
+            return prefix_ids, self._concat(pieces)
+
+    def _release(self, key: bytes) -> bool:
+        """Drop one reference to a block; True if that was the last one"""
+        self._block_refs[key] -= 1
+        if self._block_refs[key]:
+            return False
+        del self._block_refs[key]
+        return True
+
+    def evict_session(self, session_id: str) -> None:
+        """Release a session's blocks, freeing those no other session uses"""
+        with self._lock:
+            freed = 0
+            self._session_ids.pop(session_id, None)
+            for key in self._session_index.pop(session_id, []):
+                if self._release(key) and self._drop(key):
+                    freed += 1
+            if freed:
+                logger.debug("Freed %s KV blocks of evicted session %s", freed, session_id)
+
+    def clear(self) -> None:
+        """Drop all cached blocks"""
+        with self._lock:
+            for key in list(self._cold):
+                self._drop_cold(key)
+            self._blocks.clear()
+            self._depth.clear()
+            self._hits.clear()
+            self._priority.clear()
+            self._clock = 0.0
+            self._session_index.clear()
+            self._session_ids.clear()
+            self._block_refs.clear()
+
+    def close(self) -> None:
+        """Drop all blocks and remove this process's cold-tier directory"""
+        with self._lock:
+            self.clear()
+            if self.cold_dir and os.path.isdir(self.cold_dir):
+                try:
+                    os.rmdir(self.cold_dir)
+                except OSError as e:
+                    logger.warning("⚠️ Could not remove KV cold directory: %s", e)
+
+
+class SessionKVStore:
+    """
+    Per-session KV persistence backed by memory-mapped files
+    Each session gets a raw `<session_id>.kv` byte file plus a `.meta` json
+    sidecar (layer shapes, dtype, prefix token IDs and chat messages), so a
+    restarted process can resume the session without re-prefilling it.
+    Snapshots carry a fingerprint of the model that produced them and are
+    rejected on load if it differs; beyond max_sessions the oldest are removed.
+    CPU only - device memory cannot be mapped from disk.
+    """
+
+    def __init__(self, directory: str, max_sessions: int = 1000, fingerprint: Optional[Dict[str, str]] = None):
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.fingerprint = fingerprint or {}
+        os.makedirs(directory, exist_ok=True)
+        self._prune()
+
+    def _paths(self, session_id: str) -> Tuple[str, str]:
+        if os.path.basename(session_id) != session_id or session_id.startswith("."):
+            raise ValueError(f"Invalid session ID for KV store: {session_id!r}")
+        base = os.path.join(self.directory, session_id)
+        return f"{base}.kv", f"{base}.meta"
+
+    def save(
+        self,
+        session_id: str,
+        prefix_ids: torch.Tensor,
+        pairs: KVPairs,
+        extra: Dict[str, Any]
+    ) -> None:
+        """Write prefix KV tensors and metadata for a session"""
+        kv_path, meta_path = self._paths(session_id)
+        tensors = [t.detach().contiguous() for pair in pairs for t in pair]
+        total_bytes = sum(t.numel() * t.element_size() for t in tensors)
+
+        mm = np.memmap(f"{kv_path}.tmp", dtype=np.uint8, mode="w+", shape=(total_bytes,))
+        offset = 0
+        for t in tensors:
+            raw = t.cpu().reshape(-1).view(torch.uint8).numpy()
+            mm[offset:offset + raw.size] = raw
+            offset += raw.size
+        mm.flush()
+        del mm
+
+        meta = {
+            "dtype": str(tensors[0].dtype).replace("torch.", ""),
+            "shapes": [list(t.shape) for t in tensors],
+            "tokens": len(prefix_ids),
+            "input_ids": prefix_ids.tolist(),
+            "fingerprint": self.fingerprint,
+            **extra,
+        }
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        # Meta is replaced last: its presence marks a complete snapshot
+        os.replace(f"{kv_path}.tmp", kv_path)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        logger.debug("Persisted KV for session %s: %s bytes", session_id, total_bytes)
+        self._prune()
+
+    def _prune(self) -> None:
+        """Remove the oldest snapshots beyond max_sessions"""
+        metas = [
+            entry for entry in os.scandir(self.directory)
+            if entry.name.endswith(".meta") and entry.is_file()
+        ]
+        if len(metas) <= self.max_sessions:
+            return
+        metas.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in metas[:len(metas) - self.max_sessions]:
+            self.delete(entry.name[:-len(".meta")])
+        logger.debug("Pruned %s persisted KV sessions", len(metas) - self.max_sessions)
+
+    def load(self, session_id: str) -> Optional[Tuple[torch.Tensor, KVPairs, Dict[str, Any]]]:
+        """
+        Map a persisted session back into memory
+
+        Returns:
+            (prefix_ids, pairs, meta) or None if nothing usable is on disk
+        """
+        kv_path, meta_path = self._paths(session_id)
+        if not (os.path.exists(kv_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("fingerprint") != self.fingerprint:
+                # KV of another model or dtype would fail or silently mislead generation
+                logger.info("♻️ Discarding KV of session %s saved for %s", session_id, meta.get("fingerprint"))
+                self.delete(session_id)
+                return None
+            dtype = getattr(torch, meta["dtype"])
+            # Copy-on-write mapping: zero-copy reads, pages stay file-backed
+            mm = np.memmap(kv_path, dtype=np.uint8, mode="c")
+
+            tensors = []
+            offset = 0
+            for shape in meta["shapes"]:
+                n_bytes = int(np.prod(shape)) * torch.empty((), dtype=dtype).element_size()
+                raw = torch.from_numpy(mm[offset:offset + n_bytes])
+                tensors.append(raw.view(dtype).reshape(shape))
+                offset += n_bytes
+        except Exception as e:
+            logger.warning("⚠️ Could not restore KV for session %s: %s", session_id, e)
+            return None
+
+        pairs = list(zip(tensors[0::2], tensors[1::2]))
+        prefix_ids = torch.tensor(meta["input_ids"], dtype=torch.long)
+        return prefix_ids, pairs, meta
+
+    def delete(self, session_id: str) -> bool:
+        """Remove a session's persisted files; returns True if any existed"""
+        removed = False
+        for path in self._paths(session_id):
+            if os.path.exists(path):
+                os.remove(path)
+                removed = True
+        return removed
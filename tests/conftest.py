@@ -0,0 +1,70 @@
+"""
+Shared fixtures: a ChatService around a stub model, so tests need no weights
+"""
+import pytest
+import torch
+
+from backend.config import settings
+from backend.services.chat_service import ChatService, SessionCache
+
+
+class StubModel:
+    """Stands in for the causal LM; outside generate() the service only reads its dtype"""
+    dtype = torch.float32
+
+
+class FakeClock:
+    """Manually advanced timer for the session TTL cache"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def stub_turns(service: ChatService, generate) -> None:
+    """Replace tokenization and generation so chat() runs without a tokenizer or model"""
+    service._encode_message = lambda role, content: torch.tensor([1, 2, 3])
+    service._build_input_ids = lambda history, prompt_ids: prompt_ids
+    service._generate_response = generate
+
+
+def bind_kv(service: ChatService, session_id: str, tokens: int = 8) -> torch.Tensor:
+    """Cache random prefix KV for a session as a finished turn would; returns its token IDs"""
+    ids = torch.arange(tokens)
+    pairs = [(torch.randn(1, 2, tokens, 8), torch.randn(1, 2, tokens, 8)) for _ in range(2)]
+    service._kv_cache.insert(ids, pairs)
+    service._kv_cache.bind_session(session_id, torch.arange(tokens + 1))
+    return ids
+
+
+@pytest.fixture
+def make_service(monkeypatch):
+    """Build a ChatService with settings overrides and a FakeClock-driven session TTL"""
+    def load_stub(self):
+        self.model = StubModel()
+        self.model_loaded = True
+
+    monkeypatch.setattr(ChatService, "_load_model", load_stub)
+
+    def make(**overrides):
+        overrides.setdefault("MODEL_DEVICE", "cpu")
+        overrides.setdefault("KV_CACHE_BLOCK_SIZE", 4)
+        for name, value in overrides.items():
+            monkeypatch.setattr(settings, name, value)
+        service = ChatService()
+        service.clock = FakeClock()
+        service.session_store = SessionCache(
+            maxsize=settings.MAX_SESSIONS,
+            ttl=settings.SESSION_TTL_SEC,
+            on_evict=service._on_session_evicted,
+            timer=service.clock
+        )
+        return service
+
+    return make
+
+
+@pytest.fixture
+def service(make_service):
+    return make_service()
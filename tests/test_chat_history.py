@@ -0,0 +1,41 @@
+"""
+Tests for the bounded per-session chat history
+"""
+from backend.services.chat_service import BoundedChatHistory
+
+
+def test_turn_cap_drops_oldest():
+    history = BoundedChatHistory(max_turns=2, char_cap=1000)
+    for i in range(3):
+        history.add_user_message(f"q{i}")
+        history.add_ai_message(f"a{i}")
+    assert [m.content for m in history] == ["q1", "a1", "q2", "a2"]
+
+
+def test_char_cap_drops_oldest():
+    history = BoundedChatHistory(max_turns=10, char_cap=10)
+    history.add_user_message("aaaa")
+    history.add_ai_message("bbbb")
+    history.add_user_message("cccc")
+    assert [m.content for m in history] == ["bbbb", "cccc"]
+
+
+def test_char_cap_keeps_newest_message():
+    history = BoundedChatHistory(max_turns=10, char_cap=3)
+    history.add_user_message("a")
+    history.add_ai_message("too long for the cap")
+    assert [m.content for m in history] == ["too long for the cap"]
+
+
+def test_on_change_and_clear():
+    counts = []
+    history = BoundedChatHistory(max_turns=10, char_cap=100, on_change=counts.append)
+    history.add_user_message("hi")
+    history.add_ai_message("hello")
+    history.clear()
+    assert counts == [1, 2, 0]
+    assert len(history) == 0
+
+    # Clearing resets the char count: a full-size message fits again
+    history.add_user_message("x" * 100)
+    assert len(history) == 1
@@ -0,0 +1,246 @@
+"""
+Session lifecycle tests for ChatService (stub model, no weights)
+"""
+import asyncio
+import os
+import threading
+
+import pytest
+import torch
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.api.routes import require_chat_service, router
+from backend.config import settings
+from backend.services.chat_service import FALLBACK_RESPONSE, CancelCriteria, streamable_prefix
+from conftest import bind_kv, stub_turns
+
+
+@pytest.mark.asyncio
+async def test_delete_waits_for_in_flight_turn(service):
+    started, release = threading.Event(), threading.Event()
+
+    def generate(input_ids, streamer=None, max_new_tokens=None):
+        started.set()
+        release.wait(5)
+        return "A complete reply"
+
+    stub_turns(service, generate)
+    turn = asyncio.create_task(service.chat("question", "sess_1"))
+    await asyncio.to_thread(started.wait, 5)
+
+    delete = asyncio.create_task(service.delete_session("sess_1"))
+    await asyncio.sleep(0.05)
+    assert not delete.done()
+
+    release.set()
+    assert await turn == "A complete reply"
+    assert await delete
+    # The finished turn did not resurrect the deleted session
+    assert service.try_get("sess_1") is None
+    assert "sess_1" not in service._kv_cache._session_index
+
+
+def fill_history(service, session_id: str):
+    """A session with two finished turns and bound prefix KV"""
+    history = service.get_session_history(session_id)
+    for i in range(2):
+        history.add_user_message(f"question {i}")
+        history.add_ai_message(f"answer {i}")
+    bind_kv(service, session_id)
+    return history
+
+
+def expire_all(service):
+    service.clock.now += settings.SESSION_TTL_SEC + 1
+
+
+@pytest.mark.asyncio
+async def test_returning_after_ttl_revives_session(make_service, tmp_path):
+    service = make_service(KV_MMAP_DIR=str(tmp_path))
+    fill_history(service, "s_x")
+    expire_all(service)
+
+    # The expired entry is only purged by this lookup, which must still find its messages
+    history = service.get_session_history("s_x")
+    assert [m.content for m in history] == ["question 0", "answer 0", "question 1", "answer 1"]
+    assert "s_x" in service._kv_cache._session_index
+
+    # Revived before the background write ran: nothing written, KV kept
+    await asyncio.gather(*service._snapshot_tasks)
+    assert not (tmp_path / "s_x.meta").exists()
+    assert "s_x" in service._kv_cache._session_index
+
+
+@pytest.mark.asyncio
+async def test_evicted_session_written_in_background_and_restored(make_service, tmp_path):
+    service = make_service(KV_MMAP_DIR=str(tmp_path))
+    fill_history(service, "s_x")
+    expire_all(service)
+
+    assert service.get_all_sessions() == []
+    await asyncio.gather(*service._snapshot_tasks)
+    assert (tmp_path / "s_x.meta").exists()
+    assert "s_x" not in service._kv_cache._session_index
+
+    history = service.get_session_history("s_x")
+    assert len(history) == 4
+    assert "s_x" in service._kv_cache._session_index
+
+
+@pytest.mark.asyncio
+async def test_delete_drops_pending_snapshot(make_service, tmp_path):
+    service = make_service(KV_MMAP_DIR=str(tmp_path))
+    fill_history(service, "s_x")
+    expire_all(service)
+    service.get_all_sessions()
+
+    assert await service.delete_session("s_x")
+    await asyncio.gather(*service._snapshot_tasks)
+    assert os.listdir(tmp_path) == []
+    assert "s_x" not in service._kv_cache._session_index
+
+
+def test_close_persists_live_sessions(make_service, tmp_path):
+    service = make_service(KV_MMAP_DIR=str(tmp_path))
+    fill_history(service, "s_x")
+    service.close()
+
+    restarted = make_service(KV_MMAP_DIR=str(tmp_path))
+    assert len(restarted.get_session_history("s_x")) == 4
+
+
+@pytest.mark.asyncio
+async def test_delete_after_ttl_removes_written_snapshot(make_service, tmp_path):
+    service = make_service(KV_MMAP_DIR=str(tmp_path))
+    fill_history(service, "s_x")
+    expire_all(service)
+    service.get_all_sessions()
+    await asyncio.gather(*service._snapshot_tasks)
+    assert (tmp_path / "s_x.meta").exists()
+
+    assert await service.delete_session("s_x")
+    assert os.listdir(tmp_path) == []
+    assert len(service.get_session_history("s_x")) == 0
+
+
+@pytest.mark.asyncio
+async def test_clear_and_delete_expire_idle_session_first(make_service, tmp_path):
+    service = make_service(KV_MMAP_DIR=str(tmp_path))
+    fill_history(service, "s_x")
+    fill_history(service, "s_y")
+    # Nothing has purged the expired entries yet
+    expire_all(service)
+
+    assert await service.clear_history("s_x")
+    assert await service.delete_session("s_y")
+    await asyncio.gather(*service._snapshot_tasks)
+    assert os.listdir(tmp_path) == []
+    assert service._kv_cache._session_index == {}
+    assert len(service.get_session_history("s_x")) == 0
+
+
+def test_delete_unknown_session_is_idempotent(service):
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[require_chat_service] = lambda: service
+
+    with TestClient(app) as client:
+        for _ in range(2):
+            assert client.delete("/sessions/s_missing").status_code == 200
+        assert client.post("/sessions/s_missing/clear-history").status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_stream_disconnect_cancels_generation(service):
+    stopped = threading.Event()
+
+    def generate(input_ids, streamer=None, max_new_tokens=None, cancel=None):
+        # Like generate() with CancelCriteria: one token per step until cancelled
+        while not cancel.wait(0.01):
+            streamer.on_finalized_text("tok ")
+        stopped.set()
+        return "tok"
+
+    stub_turns(service, generate)
+    stream = service.chat_stream("hi", "s_x")
+    assert (await stream.__anext__()).startswith("tok")
+    await stream.aclose()
+
+    assert await asyncio.to_thread(stopped.wait, 2)
+    # The abandoned turn is not recorded
+    assert len(service.get_session_history("s_x")) == 0
+
+
+def test_cancel_criteria_follows_event():
+    cancel = threading.Event()
+    criteria = CancelCriteria(cancel)
+    input_ids = torch.zeros(2, 3, dtype=torch.long)
+    assert not criteria(input_ids, None).any()
+    cancel.set()
+    assert criteria(input_ids, None).all()
+
+
+@pytest.mark.parametrize("chunks, final", [
+    # A stop string split across chunks is never sent
+    (["Caesar crossed", " the Rubicon.\nUs", "er: and then?"], "Caesar crossed the Rubicon."),
+    # Too short to keep: only the fallback is sent
+    (["Ok", "\n"], FALLBACK_RESPONSE),
+])
+@pytest.mark.asyncio
+async def test_stream_matches_recorded_response(service, chunks, final):
+    def generate(input_ids, streamer=None, max_new_tokens=None, cancel=None):
+        for chunk in chunks:
+            streamer.on_finalized_text(chunk)
+        streamer.on_finalized_text("", stream_end=True)
+        return service._finalize_response("".join(chunks))
+
+    stub_turns(service, generate)
+    streamed = [text async for text in service.chat_stream("hi", "s_x")]
+    assert "".join(streamed) == final
+    assert list(service.get_session_history("s_x"))[-1].content == final
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("  Caesar", "Caesar"),
+    ("Caesar\nUs", "Caesar"),
+    ("Caesar\nUser: more", "Caesar"),
+    ("Caesar\nUsage", "Caesar\nUsage"),
+    ("Hi\n", ""),
+])
+def test_streamable_prefix(text, expected):
+    assert streamable_prefix(text) == expected
+
+
+def test_capacity_eviction_releases_kv_and_recycles_history(make_service):
+    service = make_service(MAX_SESSIONS=2)
+    evicted = fill_history(service, "s_0")
+    fill_history(service, "s_1")
+    fill_history(service, "s_2")
+
+    assert service.try_get("s_0") is None
+    assert "s_0" not in service._kv_cache._session_index
+    assert service._history_pool == [evicted]
+
+    # The next new session reuses the pooled object, emptied
+    assert service.get_session_history("s_3") is evicted
+    assert len(evicted) == 0
+
+
+@pytest.mark.asyncio
+async def test_delete_recycles_history(service):
+    history = fill_history(service, "s_x")
+    assert await service.delete_session("s_x")
+    assert service._history_pool == [history]
+    assert service._kv_cache._session_index == {}
+
+
+def test_no_recycle_while_a_turn_holds_the_session(service):
+    history = fill_history(service, "s_x")
+    # Referenced like an in-flight turn does, so the lock stays registered
+    lock = service._session_lock("s_x")  # noqa: F841
+    expire_all(service)
+    service.get_all_sessions()
+
+    assert service._history_pool == []
+    assert len(history) == 4
@@ -0,0 +1,202 @@
+"""
+Tests for the prefix KV cache and the mmap session store
+"""
+import os
+
+import torch
+
+from backend.services.kv_cache import PrefixKVCache, SessionKVStore, cache_from_tensors
+
+BLOCK = 4
+
+
+def make_kv(seq_len: int, layers: int = 2, dtype: torch.dtype = torch.float32):
+    """Random per-layer (key, value) tensors shaped [1, heads, seq_len, head_dim]"""
+    return [
+        (torch.randn(1, 2, seq_len, 8).to(dtype), torch.randn(1, 2, seq_len, 8).to(dtype))
+        for _ in range(layers)
+    ]
+
+
+def assert_kv_equal(actual, expected, seq_len: int):
+    assert len(actual) == len(expected)
+    for (k, v), (ek, ev) in zip(actual, expected):
+        assert torch.equal(k, ek[:, :, :seq_len])
+        assert torch.equal(v, ev[:, :, :seq_len])
+
+
+def test_lookup_hit_and_miss():
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=8)
+    ids = torch.arange(9)
+    kv = make_kv(9)
+    cache.store(ids, cache_from_tensors(kv))
+    assert len(cache) == 2
+
+    hit, cached = cache.lookup(ids)
+    assert cached == 8
+    assert hit.get_seq_length() == 8
+
+    # A fully cached prompt still leaves its last token to prefill
+    hit, cached = cache.lookup(ids[:8])
+    assert cached == 4
+
+    miss, cached = cache.lookup(torch.arange(100, 109))
+    assert miss is None and cached == 0
+
+
+def test_store_copies_block_slices():
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=8)
+    ids = torch.arange(8)
+    kv = make_kv(8)
+    cache.store(ids, cache_from_tensors(kv))
+    prefix_ids, pairs = cache.longest_prefix(ids)
+    assert torch.equal(prefix_ids, ids)
+    assert_kv_equal(pairs, kv, 8)
+
+
+def test_shared_block_survives_evicting_one_session():
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=8)
+    shared = torch.arange(BLOCK)
+    ids_a = torch.cat([shared, torch.arange(10, 10 + BLOCK)])
+    ids_b = torch.cat([shared, torch.arange(20, 20 + BLOCK)])
+    kv_a = make_kv(8)
+    # Same prefix tokens give the same KV: only the second block differs
+    kv_b = [
+        (torch.cat([k[:, :, :BLOCK], nk], dim=2), torch.cat([v[:, :, :BLOCK], nv], dim=2))
+        for (k, v), (nk, nv) in zip(kv_a, make_kv(BLOCK))
+    ]
+    cache.insert(ids_a, kv_a)
+    cache.insert(ids_b, kv_b)
+    # The first block is deduplicated: three blocks for two 2-block prompts
+    assert len(cache) == 3
+
+    cache.bind_session("a", ids_a)
+    cache.bind_session("b", ids_b)
+    cache.evict_session("a")
+
+    assert len(cache) == 2
+    assert "a" not in cache._session_index
+    prefix_ids, pairs = cache.longest_prefix(ids_b)
+    assert len(prefix_ids) == 8
+    assert_kv_equal(pairs, kv_b, 8)
+    assert cache.longest_prefix(ids_a)[0].numel() == BLOCK
+
+    cache.evict_session("b")
+    assert len(cache) == 0
+    assert not cache._block_refs
+
+
+def test_cold_tier_demote_promote_evict(tmp_path):
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=1, cold_dir=str(tmp_path), max_cold_blocks=4)
+    ids = torch.arange(8)
+    kv = make_kv(8)
+    cache.insert(ids, kv)
+
+    # Over capacity: the deeper block is offloaded to disk
+    assert len(cache) == 1
+    assert len(cache._cold) == 1
+    assert len(os.listdir(cache.cold_dir)) == 1
+
+    # A hit promotes it back (and demotes the other block instead)
+    prefix_ids, pairs = cache.longest_prefix(ids)
+    assert len(prefix_ids) == 8
+    assert_kv_equal(pairs, kv, 8)
+    assert len(cache) == 1
+    assert len(cache._cold) == 1
+
+    cache.bind_session("s", ids)
+    cache.evict_session("s")
+    assert len(cache) == 0
+    assert not cache._cold
+    assert os.listdir(cache.cold_dir) == []
+
+
+def test_cold_tier_respects_block_bound(tmp_path):
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=1, cold_dir=str(tmp_path), max_cold_blocks=2)
+    cache.insert(torch.arange(16), make_kv(16))
+    assert len(cache) == 1
+    assert len(cache._cold) == 2
+    assert len(os.listdir(cache.cold_dir)) == 2
+
+
+def test_cold_dir_is_private_to_the_process(tmp_path):
+    other = tmp_path / "worker-other"
+    other.mkdir()
+    block = other / f"{'ab' * 16}.pt"
+    block.write_bytes(b"another worker's block")
+
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=1, cold_dir=str(tmp_path))
+    cache.insert(torch.arange(8), make_kv(8))
+    assert os.path.dirname(cache.cold_dir) == str(tmp_path)
+    assert len(os.listdir(cache.cold_dir)) == 1
+
+    cache.close()
+    assert not os.path.exists(cache.cold_dir)
+    assert block.exists()
+
+
+def test_stale_cold_files_removed_on_start(tmp_path):
+    cold_dir = tmp_path / f"worker-{os.getpid()}"
+    cold_dir.mkdir()
+    stale = cold_dir / f"{'ab' * 16}.pt"
+    stale.write_bytes(b"old")
+    other = cold_dir / "notes.txt"
+    other.write_text("keep")
+    PrefixKVCache(block_size=BLOCK, cold_dir=str(tmp_path))
+    assert not stale.exists()
+    assert other.exists()
+
+
+def test_session_prefix_does_not_count_hits(tmp_path):
+    cache = PrefixKVCache(block_size=BLOCK, max_blocks=1, cold_dir=str(tmp_path))
+    ids = torch.arange(9)
+    kv = make_kv(8)
+    cache.insert(ids[:8], kv)
+    cache.bind_session("s", ids)
+    hits, priority = dict(cache._hits), dict(cache._priority)
+
+    prefix_ids, pairs = cache.session_prefix("s")
+    assert torch.equal(prefix_ids, ids[:8])
+    assert_kv_equal(pairs, kv, 8)
+    # Nothing promoted, no GreedyDual bookkeeping touched
+    assert len(cache) == 1 and len(cache._cold) == 1
+    assert cache._hits == hits and cache._priority == priority
+
+    assert cache.session_prefix("unknown")[1] is None
+
+
+def test_session_store_round_trip_bf16(tmp_path):
+    store = SessionKVStore(str(tmp_path), fingerprint={"model": "m", "dtype": "bfloat16"})
+    ids = torch.arange(8)
+    kv = make_kv(8, dtype=torch.bfloat16)
+    store.save("sess_1", ids, kv, {"messages": [{"role": "user", "content": "hi"}]})
+
+    prefix_ids, pairs, meta = store.load("sess_1")
+    assert torch.equal(prefix_ids, ids)
+    assert pairs[0][0].dtype == torch.bfloat16
+    assert_kv_equal(pairs, kv, 8)
+    assert meta["messages"] == [{"role": "user", "content": "hi"}]
+
+    store.delete("sess_1")
+    assert store.load("sess_1") is None
+
+
+def test_session_store_rejects_other_fingerprint(tmp_path):
+    SessionKVStore(str(tmp_path), fingerprint={"model": "m", "dtype": "bfloat16"}).save(
+        "sess_1", torch.arange(4), make_kv(4), {}
+    )
+    store = SessionKVStore(str(tmp_path), fingerprint={"model": "m", "dtype": "float32"})
+    assert store.load("sess_1") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_session_store_prunes_oldest(tmp_path):
+    store = SessionKVStore(str(tmp_path), max_sessions=2)
+    for i in range(3):
+        store.save(f"sess_{i}", torch.arange(4), make_kv(4), {})
+        # Distinct mtimes regardless of filesystem timestamp resolution
+        os.utime(tmp_path / f"sess_{i}.meta", (i, i))
+    store.save("sess_3", torch.arange(4), make_kv(4), {})
+    assert sorted(os.listdir(tmp_path)) == [
+        "sess_2.kv", "sess_2.meta", "sess_3.kv", "sess_3.meta"
+    ]
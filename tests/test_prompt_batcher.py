@@ -0,0 +1,68 @@
+"""
+Tests for the batch inference queue behind ChatService.chat (stub model)
+"""
+import asyncio
+
+import pytest
+import torch
+
+from backend.services.chat_service import PromptBatcher
+from conftest import stub_turns
+
+
+def stub_batcher(service, calls):
+    """Route the batcher to stubs that record their calls and echo the session prompt"""
+    def infer_one(input_ids, max_new_tokens=None):
+        calls.append(("one", 1))
+        return f"reply {int(input_ids[-1])}"
+
+    def infer_batch(batch, max_new_tokens):
+        calls.append(("batch", len(batch)))
+        return [f"reply {int(input_ids[-1])}" for input_ids in batch]
+
+    stub_turns(service, infer_one)
+    # Each prompt ends in its own token so replies can be matched to sessions
+    service._encode_message = lambda role, content: torch.tensor([int(content.split()[-1])])
+    service._batcher._infer_one = infer_one
+    service._batcher._infer_batch = infer_batch
+
+
+@pytest.mark.asyncio
+async def test_concurrent_chats_share_one_batch(make_service):
+    service = make_service(BATCH_MAX_SIZE=8, BATCH_MAX_WAIT_MS=200)
+    calls = []
+    stub_batcher(service, calls)
+    service.start_batch_worker()
+    try:
+        replies = await asyncio.gather(*(service.chat(f"prompt {i}", f"s_{i}") for i in range(3)))
+    finally:
+        await service.stop_batch_worker()
+
+    assert calls == [("batch", 3)]
+    assert replies == ["reply 0", "reply 1", "reply 2"]
+    for i in range(3):
+        assert [m.content for m in service.get_session_history(f"s_{i}")] == [f"prompt {i}", f"reply {i}"]
+
+
+@pytest.mark.asyncio
+async def test_lone_chat_keeps_single_prompt_path(make_service):
+    service = make_service(BATCH_MAX_SIZE=8, BATCH_MAX_WAIT_MS=1)
+    calls = []
+    stub_batcher(service, calls)
+    service.start_batch_worker()
+    try:
+        assert await service.chat("prompt 7", "s_x") == "reply 7"
+    finally:
+        await service.stop_batch_worker()
+    assert calls == [("one", 1)]
+
+
+@pytest.mark.asyncio
+async def test_stop_fails_queued_requests():
+    batcher = PromptBatcher(infer_one=None, infer_batch=None, max_size=4, max_wait_ms=1)
+    # Never started: the request stays queued until stop()
+    pending = asyncio.ensure_future(batcher.submit(torch.tensor([1])))
+    await asyncio.sleep(0)
+    await batcher.stop()
+    with pytest.raises(RuntimeError, match="Batch worker stopped"):
+        await pending